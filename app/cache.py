@@ -0,0 +1,261 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(*parts):
+    """
+    Genera una clave estable a partir de los parámetros recibidos.
+
+    Parámetros:
+      - parts: valores serializables a JSON (cadenas, diccionarios, listas, números).
+
+    Retorna:
+      - Un hash sha256 en formato hexadecimal.
+    """
+    raw = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 256, ttl: float = 3600):
+        """
+        Cache en memoria con expiración (TTL) y desalojo LRU por tamaño.
+
+        Parámetros:
+          - maxsize: número máximo de entradas a conservar.
+          - ttl: segundos de vida por defecto de cada entrada (None para no expirar).
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Retorna el valor asociado a la clave o None si no existe o expiró.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Guarda un valor en el cache.
+
+        Parámetros:
+          - key: clave de la entrada.
+          - value: valor a guardar.
+          - ttl: segundos de vida de la entrada (por defecto el TTL del cache).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Retorna los contadores de aciertos y fallos del cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._data),
+        }
+
+
+class SQLiteCache:
+    def __init__(self, path: str, ttl: float = 86400, table: str = "cache"):
+        """
+        Cache persistente en un archivo SQLite. Los valores deben ser serializables a JSON.
+
+        Parámetros:
+          - path: ruta del archivo SQLite.
+          - ttl: segundos de vida por defecto de cada entrada (None para no expirar).
+          - table: nombre de la tabla donde se guardan las entradas.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.table = table
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at < time.time():
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(value)
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, default=str), expires_at)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class TieredCache:
+    def __init__(self, memory: LRUCache, disk: SQLiteCache = None):
+        """
+        Combina un cache en memoria con un nivel opcional en disco.
+        Los aciertos en disco se promueven al nivel de memoria.
+
+        Parámetros:
+          - memory: instancia de LRUCache.
+          - disk: instancia opcional de SQLiteCache.
+        """
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory": self.memory.stats(),
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+class SnowflakeTableCache:
+    def __init__(self, session, table: str, ttl: float = 86400):
+        """
+        Cache persistente en una tabla de Snowflake, compartida entre procesos y usuarios.
+        Los valores deben ser serializables a JSON.
+
+        Parámetros:
+          - session: objeto de sesión de Snowflake.
+          - table: nombre (calificado) de la tabla donde se guardan las entradas.
+          - ttl: segundos de vida por defecto de cada entrada (None para no expirar).
+        """
+        self.session = session
+        self.table = table
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.session.sql(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key STRING PRIMARY KEY, value STRING, expires_at FLOAT)"
+        ).collect()
+
+    def get(self, key):
+        rows = self.session.sql(
+            f"SELECT value, expires_at FROM {self.table} WHERE key = ?", params=[key]
+        ).collect()
+        if not rows:
+            self.misses += 1
+            return None
+        value, expires_at = rows[0]["VALUE"], rows[0]["EXPIRES_AT"]
+        if expires_at is not None and expires_at < time.time():
+            self.session.sql(f"DELETE FROM {self.table} WHERE key = ?", params=[key]).collect()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        self.session.sql(
+            f"MERGE INTO {self.table} t USING (SELECT ? AS key, ? AS value, ? AS expires_at) s "
+            "ON t.key = s.key "
+            "WHEN MATCHED THEN UPDATE SET t.value = s.value, t.expires_at = s.expires_at "
+            "WHEN NOT MATCHED THEN INSERT (key, value, expires_at) VALUES (s.key, s.value, s.expires_at)",
+            params=[key, json.dumps(value, default=str), expires_at]
+        ).collect()
+
+    def clear(self):
+        self.session.sql(f"DELETE FROM {self.table}").collect()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
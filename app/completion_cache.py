@@ -0,0 +1,58 @@
+import re
+
+from app.cache import make_cache_key
+
+
+class CompletionCache:
+    def __init__(self, backend, ttl: float = None, enabled: bool = True):
+        """
+        Memoiza las respuestas de SNOWFLAKE.CORTEX.COMPLETE por modelo, prompt normalizado y opciones.
+
+        Parámetros:
+          - backend: almacenamiento de las entradas (LRUCache, SQLiteCache, TieredCache o SnowflakeTableCache).
+          - ttl: segundos de vida de cada respuesta (None para usar el TTL del backend).
+          - enabled: permite desactivar el cache sin quitarlo de los servicios.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+
+    @staticmethod
+    def normalize_prompt(prompt: str):
+        """
+        Normaliza el prompt para que diferencias de espacios no generen entradas distintas.
+        """
+        return re.sub(r"\s+", " ", prompt).strip()
+
+    def make_key(self, model: str, prompt: str, options: dict = None):
+        parts = ["complete", model, self.normalize_prompt(prompt)]
+        # Sin opciones se conserva la clave anterior para no invalidar los caches persistentes
+        if options:
+            parts.append(options)
+        return make_cache_key(*parts)
+
+    def get(self, model: str, prompt: str, options: dict = None):
+        """
+        Retorna la respuesta guardada para el modelo, prompt y opciones, o None si no existe.
+        """
+        if not self.enabled:
+            return None
+        return self.backend.get(self.make_key(model, prompt, options))
+
+    def set(self, model: str, prompt: str, response: str, ttl: float = None, options: dict = None):
+        """
+        Guarda la respuesta del modelo para el prompt.
+
+        Parámetros:
+          - model: nombre del modelo usado en COMPLETE.
+          - prompt: prompt enviado al modelo (sin escapar).
+          - response: respuesta generada.
+          - ttl: segundos de vida de esta entrada (por defecto el TTL del cache).
+          - options: opciones de COMPLETE usadas (max_tokens, temperature, etc.).
+        """
+        if not self.enabled:
+            return
+        self.backend.set(self.make_key(model, prompt, options), response, self.ttl if ttl is None else ttl)
+
+    def stats(self):
+        return self.backend.stats()
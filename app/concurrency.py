@@ -0,0 +1,95 @@
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from app.tracing import tracer
+
+# Errores de Snowflake/Cortex que indican que se superó el límite de solicitudes
+RATE_LIMITED = re.compile(r"\b429\b|too many requests|rate limit|throttl", re.IGNORECASE)
+
+
+class ConcurrencyLimits:
+    def __init__(self):
+        """
+        Límites globales (por proceso) de llamadas concurrentes a Snowflake por tipo ('complete',
+        'execute'), compartidos por todos los usuarios de la app, y reintentos con backoff
+        exponencial cuando Snowflake responde que se superó el límite de solicitudes.
+
+        Sin configure no hay límites: cada llamada pasa directamente.
+        """
+        self._semaphores = {}
+        self.max_retries = 5
+        self.base_delay = 1.0
+        self.max_delay = 30.0
+
+    def configure(self, complete: int = None, execute: int = None, max_retries: int = 5,
+                  base_delay: float = 1.0, max_delay: float = 30.0):
+        """
+        Parámetros:
+          - complete: llamadas a COMPLETE en curso como máximo (None para no limitarlas).
+          - execute: sentencias o lotes de SQL generado en ejecución como máximo (None para no limitarlas).
+          - max_retries: reintentos ante errores de límite de solicitudes.
+          - base_delay: espera inicial del backoff, en segundos.
+          - max_delay: espera máxima entre reintentos, en segundos.
+        """
+        self._semaphores = {
+            kind: threading.BoundedSemaphore(limit)
+            for kind, limit in (("complete", complete), ("execute", execute)) if limit
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @contextmanager
+    def slot(self, kind: str):
+        """
+        Ocupa un cupo del tipo indicado mientras dura el bloque (espera si no hay cupos libres).
+        """
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            yield
+            return
+        start = time.perf_counter()
+        semaphore.acquire()
+        waited_ms = (time.perf_counter() - start) * 1000
+        if waited_ms >= 1:
+            with tracer.span("slot_wait", kind=kind) as span:
+                span["waited_ms"] = round(waited_ms, 2)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def retry(self, fn, *args, **kwargs):
+        """
+        Llama a fn reintentando con backoff exponencial (con jitter) si falla por límite de solicitudes.
+        Cualquier otro error se propaga de inmediato.
+        """
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not RATE_LIMITED.search(str(e)):
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+                with tracer.span("rate_limited", attempt=attempt + 1, delay_s=round(delay, 2)):
+                    time.sleep(delay)
+                attempt += 1
+
+    def call(self, kind: str, fn, *args, **kwargs):
+        """
+        Llama a fn ocupando un cupo del tipo indicado y reintentando ante límites de solicitudes.
+        El cupo se libera durante la espera del backoff.
+        """
+        def limited():
+            with self.slot(kind):
+                return fn(*args, **kwargs)
+
+        return self.retry(limited)
+
+
+# Instancia compartida por todos los servicios
+limits = ConcurrencyLimits()
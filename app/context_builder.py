@@ -0,0 +1,136 @@
+import re
+
+from app.sql_splitter import split_sql
+
+# Presupuesto aproximado de tokens para el contexto del prompt de generación de código, por modelo.
+# Es mucho menor que la ventana de cada modelo: se busca que el prompt no crezca con el plan.
+MODEL_TOKEN_BUDGETS = {
+    "claude-3-5-sonnet": 12000,
+    "mistral-large2": 8000,
+    "llama3.1-70b": 6000,
+    "llama3.1-8b": 4000,
+}
+DEFAULT_TOKEN_BUDGET = 6000
+
+
+def estimate_tokens(text: str):
+    """
+    Estimación rápida de tokens (aprox. 4 caracteres por token), sin depender del tokenizador del modelo.
+    """
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int):
+    """
+    Recorta el texto para que no supere max_tokens (estimados).
+    """
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "\n... (truncado)"
+
+
+def summarize_sql(sql_code: str):
+    """
+    Resume código SQL dejando solo la primera línea de cada sentencia (ej. CREATE OR REPLACE TABLE x).
+    Las sentencias se separan con split_sql, que respeta los ';' de literales y cuerpos $$ ... $$.
+    """
+    lines = []
+    for statement in split_sql(sql_code):
+        statement = statement.strip()
+        if statement:
+            lines.append(statement.splitlines()[0].strip() + " ...;")
+    return "\n".join(lines)
+
+
+def _statement_key(sql_code: str):
+    # Las sentencias regeneradas cambian, pero suelen mantener su cabecera (CREATE ... nombre)
+    return re.sub(r"\s+", " ", sql_code.strip().splitlines()[0] if sql_code.strip() else "").upper()[:200]
+
+
+class PromptContextBuilder:
+    def __init__(self, model: str, token_budget: int = None, full_code_steps: int = 2,
+                 search_budget_ratio: float = 0.3):
+        """
+        Construye el contexto del prompt de cada intento respetando un presupuesto de tokens.
+
+        Parámetros:
+          - model: modelo usado en COMPLETE (define el presupuesto por defecto).
+          - token_budget: presupuesto total de tokens estimados (por defecto según el modelo).
+          - full_code_steps: número de pasos anteriores más recientes cuyo código se incluye completo;
+            el de los más antiguos se resume.
+          - search_budget_ratio: fracción del presupuesto reservada al contexto de Cortex Search.
+        """
+        self.model = model
+        self.token_budget = token_budget or MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+        self.full_code_steps = full_code_steps
+        self.search_budget_ratio = search_budget_ratio
+        self.errors = {}
+
+    @property
+    def search_token_budget(self):
+        """
+        Tokens disponibles para el contexto de Cortex Search.
+        """
+        return int(self.token_budget * self.search_budget_ratio)
+
+    def record_attempt(self, statements: list, outputs: list):
+        """
+        Registra el resultado de un intento. Solo se conserva el error más reciente de cada sentencia
+        y se olvidan los errores de sentencias que ya se ejecutaron con éxito.
+
+        Parámetros:
+          - statements: sentencias SQL ejecutadas en el intento.
+          - outputs: lista de (resultado, éxito) de cada sentencia.
+        """
+        for sql_code, (output, success) in zip(statements, outputs):
+            key = _statement_key(sql_code)
+            if success:
+                self.errors.pop(key, None)
+            else:
+                self.errors[key] = (sql_code, str(output))
+
+    def build(self, step: str, previous_steps: list, attempt_code: str = ""):
+        """
+        Construye el contexto para generar el código de un paso.
+
+        Parámetros:
+          - step: descripción del paso (siempre se incluye completa).
+          - previous_steps: lista de (índice, código) de los pasos anteriores ejecutados con éxito.
+          - attempt_code: código del último intento fallido del paso.
+
+        Retorna:
+          - El contexto a enviar a generate_code.
+        """
+        budget = self.token_budget - self.search_token_budget - estimate_tokens(step)
+
+        errors = ""
+        if self.errors:
+            errors = "\nErrors from the previous attempt:\n" + "\n".join(
+                f"Error: {sql_code}\n -> {output}\n{'*'*30}" for sql_code, output in self.errors.values()
+            )
+            errors = truncate_to_tokens(errors, max(budget // 2, 0))
+        budget -= estimate_tokens(errors)
+
+        attempt = ""
+        if attempt_code:
+            attempt = truncate_to_tokens(f"\nCode of the previous attempt:\n{attempt_code}\n", max(budget // 2, 0))
+        budget -= estimate_tokens(attempt)
+
+        # Código de pasos anteriores: los más recientes completos, los antiguos resumidos, y se
+        # descartan los que ya no caben en el presupuesto
+        blocks = []
+        for position, (idx, code) in enumerate(reversed(previous_steps)):
+            block = code if position < self.full_code_steps else summarize_sql(code)
+            block = f"\n-- Step {idx}\n{block}\n"
+            cost = estimate_tokens(block)
+            if cost > budget:
+                block = f"\n-- Step {idx}\n{summarize_sql(code)}\n"
+                cost = estimate_tokens(block)
+                if cost > budget:
+                    break
+            blocks.append(block)
+            budget -= cost
+        previous = 'Code previusly generated\n' + "".join(reversed(blocks))
+
+        return step + previous + attempt + errors
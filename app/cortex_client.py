@@ -0,0 +1,249 @@
+import copy
+import json
+import threading
+import time
+
+from snowflake.cortex import Complete
+from app.completion_cache import CompletionCache
+from app.concurrency import limits
+from app.context_builder import estimate_tokens
+from app.tracing import tracer
+
+
+class CortexClient:
+    def __init__(self, session, completion_cache: CompletionCache = None, options: dict = None):
+        """
+        Cliente compartido para SNOWFLAKE.CORTEX.COMPLETE.
+
+        El prompt y las opciones viajan siempre como variables enlazadas, nunca pegados en el texto
+        SQL: la sentencia es corta y constante (Snowflake reutiliza su compilación), no se registra
+        el prompt completo en el historial de consultas y no hay problemas con comillas ni barras
+        invertidas.
+
+        Parámetros:
+          - session: objeto de sesión de Snowflake.
+          - completion_cache: cache opcional de respuestas de COMPLETE compartido entre servicios.
+          - options: opciones por defecto de COMPLETE (p.ej. {"max_tokens": 2048, "temperature": 0}).
+            max_tokens limita el largo de la respuesta y con eso la latencia de cada llamada.
+        """
+        self.session = session
+        self.completion_cache = completion_cache
+        self.options = options
+        # Consultas COMPLETE en curso (query_id -> AsyncJob), para poder cancelarlas
+        self.running_jobs = {}
+        self._jobs_lock = threading.Lock()
+
+    def with_session(self, session):
+        """
+        Retorna una copia del cliente que usa otra sesión de Snowflake (comparte el cache, pero no
+        las consultas en curso).
+        """
+        client = copy.copy(self)
+        client.session = session
+        client.running_jobs = {}
+        client._jobs_lock = threading.Lock()
+        return client
+
+    def cancel_running_queries(self):
+        """
+        Cancela las consultas COMPLETE en curso de este cliente (no las llamadas en streaming, que no
+        son consultas: se detienen al dejar de consumir el generador).
+
+        Retorna:
+          - La lista de query_id cancelados.
+        """
+        with self._jobs_lock:
+            jobs = list(self.running_jobs.items())
+            self.running_jobs.clear()
+        cancelled = []
+        for query_id, job in jobs:
+            try:
+                job.cancel()
+                cancelled.append(query_id)
+            except Exception:
+                pass
+        return cancelled
+
+    def _options(self, options: dict = None):
+        merged = dict(self.options or {})
+        merged.update(options or {})
+        return merged or None
+
+    def _cached(self, model: str, prompt: str, options: dict, use_cache: bool, span: dict):
+        if not use_cache:
+            return None
+        cached = self.completion_cache.get(model, prompt, options)
+        span["cached"] = cached is not None
+        if cached is not None:
+            span["response_tokens"] = estimate_tokens(cached)
+        return cached
+
+    def _collect(self, query: str, params: list, span: dict):
+        # Asíncrona para registrar el query_id de COMPLETE en el tracing y poder cancelarla
+        job = self.session.sql(query, params=params).collect_nowait()
+        span["query_id"] = job.query_id
+        with self._jobs_lock:
+            self.running_jobs[job.query_id] = job
+        try:
+            return job.result()
+        finally:
+            with self._jobs_lock:
+                self.running_jobs.pop(job.query_id, None)
+
+    @staticmethod
+    def parse_response(response, span: dict = None):
+        """
+        Extrae el texto de la respuesta de COMPLETE. Con opciones, COMPLETE retorna un JSON con
+        'choices' y 'usage' en lugar del texto.
+        """
+        if isinstance(response, str) and not response.lstrip().startswith("{"):
+            return response
+        try:
+            data = json.loads(response) if isinstance(response, str) else response
+            text = data["choices"][0]["messages"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            return response
+        if span is not None and data.get("usage"):
+            span["usage"] = data["usage"]
+        return text
+
+    def complete(self, model: str, prompt: str, options: dict = None, use_cache: bool = True, stats: dict = None):
+        """
+        Genera la respuesta del modelo para un prompt.
+
+        Parámetros:
+          - model: nombre del modelo a utilizar en COMPLETE.
+          - prompt: la cadena que contiene el prompt completo (sin escapar).
+          - options: opciones de COMPLETE para esta llamada (se combinan con las del cliente).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - stats: diccionario opcional donde se indica si la respuesta vino del cache ('cached'), p.ej.
+            para no registrar su latencia como la del modelo.
+
+        Retorna:
+          - La respuesta generada por el modelo.
+        """
+        options = self._options(options)
+        use_cache = use_cache and self.completion_cache is not None
+        with tracer.span("complete", model=model, prompt_chars=len(prompt),
+                         prompt_tokens=estimate_tokens(prompt), options=options) as span:
+            cached = self._cached(model, prompt, options, use_cache, span)
+            if stats is not None:
+                stats["cached"] = cached is not None
+            if cached is not None:
+                return cached
+
+            if options is None:
+                query = "SELECT SNOWFLAKE.CORTEX.COMPLETE(?, ?) AS response"
+                params = [model, prompt]
+            else:
+                # Con opciones, el prompt se envía como lista de mensajes
+                query = ("SELECT SNOWFLAKE.CORTEX.COMPLETE(?, PARSE_JSON(?)::ARRAY, PARSE_JSON(?)::OBJECT) "
+                         "AS response")
+                params = [model, json.dumps([{"role": "user", "content": prompt}]), json.dumps(options)]
+            response = limits.call("complete", self._collect, query, params, span)[0]['RESPONSE']
+            result = self.parse_response(response, span)
+
+            span["response_chars"] = len(result)
+            span["response_tokens"] = estimate_tokens(result)
+            if use_cache:
+                self.completion_cache.set(model, prompt, result, options=options)
+            return result
+
+    def complete_many(self, model: str, prompts: list, options: dict = None, use_cache: bool = True):
+        """
+        Genera las respuestas de varios prompts con una sola consulta COMPLETE sobre un conjunto de filas.
+        Los prompts viajan como variables enlazadas en una lista VALUES y Snowflake procesa las filas
+        en paralelo.
+
+        Parámetros:
+          - model: nombre del modelo a utilizar en COMPLETE.
+          - prompts: lista de prompts completos.
+          - options: opciones de COMPLETE (se combinan con las del cliente).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+
+        Retorna:
+          - Lista de respuestas en el mismo orden que prompts.
+        """
+        options = self._options(options)
+        use_cache = use_cache and self.completion_cache is not None
+        responses = [None] * len(prompts)
+        if use_cache:
+            for i, prompt in enumerate(prompts):
+                responses[i] = self.completion_cache.get(model, prompt, options)
+        pending = [i for i, response in enumerate(responses) if response is None]
+        if not pending:
+            return responses
+
+        values = ", ".join("(?, ?)" for _ in pending)
+        params = [model]
+        if options is None:
+            completion = "SNOWFLAKE.CORTEX.COMPLETE(?, column2)"
+        else:
+            completion = ("SNOWFLAKE.CORTEX.COMPLETE(?, ARRAY_CONSTRUCT(OBJECT_CONSTRUCT('role', 'user', "
+                          "'content', column2)), PARSE_JSON(?)::OBJECT)")
+            params.append(json.dumps(options))
+        query = f"SELECT column1 AS idx, {completion} AS response FROM VALUES {values}"
+        for i in pending:
+            params += [i, prompts[i]]
+
+        with tracer.span("complete_many", model=model, prompts=len(pending), options=options,
+                         prompt_tokens=sum(estimate_tokens(prompts[i]) for i in pending)) as span:
+            for row in limits.call("complete", self._collect, query, params, span):
+                idx = row['IDX']
+                responses[idx] = self.parse_response(row['RESPONSE'])
+                if use_cache:
+                    self.completion_cache.set(model, prompts[idx], responses[idx], options=options)
+            span["response_tokens"] = sum(estimate_tokens(responses[i] or "") for i in pending)
+        return responses
+
+    def stream(self, model: str, prompt: str, options: dict = None, use_cache: bool = True, stats: dict = None):
+        """
+        Llama a COMPLETE en modo streaming (API de Python de Cortex) y entrega la respuesta por fragmentos.
+
+        Parámetros:
+          - model: nombre del modelo a utilizar en COMPLETE.
+          - prompt: la cadena que contiene el prompt completo (sin escapar).
+          - options: opciones de COMPLETE (se combinan con las del cliente).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - stats: diccionario opcional donde se indica si la respuesta vino del cache ('cached').
+
+        Los límites de solicitudes (429) al abrir el stream se reintentan; un error después del primer
+        fragmento se propaga, porque el texto ya entregado no se puede repetir.
+
+        Retorna:
+          - Un generador de fragmentos de texto. Si la respuesta está en cache se entrega completa.
+        """
+        options = self._options(options)
+        use_cache = use_cache and self.completion_cache is not None
+        with tracer.span("complete_stream", model=model, prompt_chars=len(prompt),
+                         prompt_tokens=estimate_tokens(prompt), options=options) as span:
+            cached = self._cached(model, prompt, options, use_cache, span)
+            if stats is not None:
+                stats["cached"] = cached is not None
+            if cached is not None:
+                yield cached
+                return
+
+            def open_stream():
+                # La solicitud puede fallar (p.ej. 429) al crear el stream o al pedir el primer
+                # fragmento: ambos quedan dentro del reintento
+                stream = iter(Complete(model, prompt, options=options, session=self.session, stream=True))
+                return stream, next(stream, None)
+
+            start = time.perf_counter()
+            chunks = []
+            stream, chunk = limits.call("complete", open_stream)
+            while chunk is not None:
+                if not chunks:
+                    span["first_chunk_ms"] = round((time.perf_counter() - start) * 1000, 2)
+                chunks.append(chunk)
+                # El cupo no se ocupa mientras el consumidor procesa el fragmento, solo al pedir el siguiente
+                yield chunk
+                with limits.slot("complete"):
+                    chunk = next(stream, None)
+
+            response = "".join(chunks)
+            span["response_chars"] = len(response)
+            span["response_tokens"] = estimate_tokens(response)
+            if use_cache:
+                self.completion_cache.set(model, prompt, response, options=options)
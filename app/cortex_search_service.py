@@ -1,5 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from snowflake.core import Root
 
+from app.cache import make_cache_key
+from app.context_builder import estimate_tokens
+from app.tracing import tracer
+
+
+class SearchResponse:
+    """
+    Respuesta mínima del Cortex Search Service, usada al servir resultados desde el cache.
+    """
+    def __init__(self, results: list):
+        self.results = results
+
 
 # Clase que encapsula el servicio Cortex Search
 class CortexSearchService:
@@ -8,7 +22,8 @@ class CortexSearchService:
                  service_schema: str,
                  service_name: str,
                  col_context: str,
-                 col_search: str
+                 col_search: str,
+                 cache=None
                  ):
         """
         Inicializa el objeto CortexSearchService.
@@ -18,6 +33,7 @@ class CortexSearchService:
           - service_database: nombre de la base de datos donde reside el servicio.
           - service_schema: nombre del esquema donde reside el servicio.
           - service_name: nombre del servicio Cortex Search.
+          - cache: cache opcional (LRUCache, SQLiteCache o TieredCache) para los resultados de búsqueda.
         """
         self.session = session
         self.service_database = service_database
@@ -25,6 +41,7 @@ class CortexSearchService:
         self.service_name = service_name
         self.col_context = col_context
         self.col_search = col_search
+        self.cache = cache
 
         self.columns = [self.col_context, self.col_search]
 
@@ -50,15 +67,42 @@ class CortexSearchService:
         Retorna:
           - La respuesta de la consulta en formato JSON.
         """
-        resp = self.service.search(
-            query=query,
-            columns=self.columns,
-            filter=filter_,
-            limit=limit
-        )
-        return resp
+        with tracer.span("search", query_chars=len(query), limit=limit) as span:
+            if self.cache is None:
+                resp = self.service.search(
+                    query=query,
+                    columns=self.columns,
+                    filter=filter_,
+                    limit=limit
+                )
+                span["results"] = len(resp.results)
+                return resp
+
+            # La clave incluye todo lo que cambia el resultado de la búsqueda
+            key = make_cache_key(self.service_name, query, filter_, self.columns, limit)
+            results = self.cache.get(key)
+            span["cached"] = results is not None
+            if results is None:
+                resp = self.service.search(
+                    query=query,
+                    columns=self.columns,
+                    filter=filter_,
+                    limit=limit
+                )
+                results = [dict(r) for r in resp.results]
+                self.cache.set(key, results)
+            span["results"] = len(results)
+            return SearchResponse(results)
+
+    def cache_stats(self):
+        """
+        Retorna los contadores de aciertos y fallos del cache de búsqueda (None si no hay cache).
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
-    def generate_context(self, query, filter_, limit=10):
+    def generate_context(self, query, filter_, limit=10, max_tokens=None):
         """
         Realiza una consulta al Cortex Search Service y genera un contexto.
 
@@ -66,19 +110,86 @@ class CortexSearchService:
           - query: cadena de búsqueda.
           - filter_: diccionario con la definición del filtro.
           - limit: número máximo de resultados a retornar (por defecto 10).
+          - max_tokens: presupuesto opcional de tokens estimados; los documentos que no caben se omiten.
 
         Retorna:
-          - El contexto generado.
+          - El contexto generado, sin documentos repetidos.
         """
 
         results = self.search(query, filter_, limit).results
+        return self.format_context(results, max_tokens=max_tokens)
 
+    def format_context(self, results, max_tokens=None, seen=None):
+        """
+        Convierte los resultados de una búsqueda en el texto de contexto para el prompt.
+
+        Parámetros:
+          - results: resultados de la búsqueda.
+          - max_tokens: presupuesto opcional de tokens estimados; los documentos que no caben se omiten.
+          - seen: conjunto opcional de documentos (col_context) ya incluidos; se actualiza.
+
+        Retorna:
+          - El contexto generado, sin documentos repetidos.
+        """
+        seen = set() if seen is None else seen
         context_str = ""
         for _, r in enumerate(results):
-            context_str += f"Context document {r[self.col_context]}: {r[self.col_search]} \n" + "\n"
+            if r[self.col_context] in seen:
+                continue
+            document = f"Context document {r[self.col_context]}: {r[self.col_search]} \n" + "\n"
+            if max_tokens is not None and estimate_tokens(context_str + document) > max_tokens:
+                break
+            seen.add(r[self.col_context])
+            context_str += document
 
         return context_str
 
+    def search_many(self, queries, filter_, limit=10, max_workers=8):
+        """
+        Realiza varias consultas al Cortex Search Service de forma concurrente.
+
+        Parámetros:
+          - queries: lista de cadenas de búsqueda.
+          - filter_: diccionario con la definición del filtro (común a todas las consultas).
+          - limit: número máximo de resultados por consulta.
+          - max_workers: número máximo de consultas simultáneas.
+
+        Retorna:
+          - Lista de respuestas, en el mismo orden que queries.
+        """
+        if not queries:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+            return list(executor.map(tracer.bind(lambda query: self.search(query, filter_, limit)), queries))
+
+    def generate_context_many(self, queries, filter_, limit=10, max_tokens=None, merge=False, max_workers=8):
+        """
+        Obtiene el contexto de varias consultas en una sola llamada, con las búsquedas en paralelo.
+
+        Parámetros:
+          - queries: lista de cadenas de búsqueda (p.ej. la descripción de cada paso del plan).
+          - filter_: diccionario con la definición del filtro.
+          - limit: número máximo de resultados por consulta.
+          - max_tokens: presupuesto opcional de tokens por contexto (o del contexto combinado si merge=True).
+          - merge: si es True retorna un único contexto con todos los documentos, sin repetir ninguno
+            (por col_context) entre consultas.
+          - max_workers: número máximo de consultas simultáneas.
+
+        Retorna:
+          - Lista de contextos en el orden de queries, o un único contexto si merge=True.
+        """
+        responses = self.search_many(queries, filter_, limit, max_workers)
+        if merge:
+            seen = set()
+            merged = []
+            for resp in responses:
+                for r in resp.results:
+                    if r[self.col_context] not in seen:
+                        seen.add(r[self.col_context])
+                        merged.append(r)
+            return self.format_context(merged, max_tokens=max_tokens)
+        return [self.format_context(resp.results, max_tokens=max_tokens) for resp in responses]
+
 
 # Ejemplo de uso:
 if __name__ == "__main__":
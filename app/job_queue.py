@@ -0,0 +1,332 @@
+import contextlib
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+class QueueFullError(RuntimeError):
+    """
+    La cola no admite más trabajos (del usuario o en total).
+    """
+
+
+class JobCancelled(Exception):
+    """
+    El trabajo fue cancelado; se lanza desde RecordingUI para cortar su ejecución.
+    """
+
+
+class Job:
+    def __init__(self, user: str, fn, args: tuple, kwargs: dict):
+        """
+        Trabajo encolado en JobQueue. fn se llama como fn(job, *args, **kwargs) en un hilo de la cola
+        y puede registrar su progreso con record (normalmente a través de RecordingUI).
+        """
+        self.job_id = uuid.uuid4().hex[:12]
+        self.user = user
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._cancel_callbacks = []
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def record(self, target, name: str, args: tuple = (), kwargs: dict = None):
+        """
+        Registra una llamada de interfaz (ver RecordingUI).
+
+        Retorna:
+          - El identificador del elemento que produce la llamada (para llamadas sobre él).
+        """
+        with self._lock:
+            result_id = len(self.events)
+            self.events.append((target, name, args, kwargs or {}, result_id))
+        return result_id
+
+    def events_snapshot(self):
+        with self._lock:
+            return list(self.events)
+
+    def on_cancel(self, callback):
+        """
+        Registra una función a llamar si el trabajo se cancela (p.ej. cancel_running_queries).
+        """
+        self._cancel_callbacks.append(callback)
+
+    def cancel(self):
+        self._cancelled.set()
+        for callback in list(self._cancel_callbacks):
+            try:
+                callback()
+            except Exception:
+                pass
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def cancel_event(self):
+        """
+        threading.Event que se activa al cancelar el trabajo (para detener su ejecución desde otros hilos).
+        """
+        return self._cancelled
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(f"El trabajo {self.job_id} fue cancelado")
+
+
+class JobQueue:
+    def __init__(self, workers: int = 4, max_running_per_user: int = 1, max_queued_per_user: int = 3,
+                 max_queued: int = 50, retention: float = 3600):
+        """
+        Cola de trabajos compartida por todos los usuarios de la app (una por proceso). Los trabajos
+        se ejecutan en hilos propios, fuera del hilo de cada request de Streamlit, por lo que
+        sobreviven a los reruns de la página.
+
+        Los usuarios se atienden por turnos (round robin): un usuario con muchos trabajos encolados no
+        bloquea a los demás, y cada uno tiene como máximo max_running_per_user trabajos en ejecución.
+
+        Parámetros:
+          - workers: trabajos en ejecución como máximo.
+          - max_running_per_user: trabajos en ejecución como máximo por usuario.
+          - max_queued_per_user: trabajos pendientes (encolados o en ejecución) como máximo por usuario.
+          - max_queued: trabajos encolados como máximo en total.
+          - retention: segundos que se conservan los trabajos terminados para consultar su progreso.
+        """
+        self.max_running_per_user = max_running_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued = max_queued
+        self.retention = retention
+        self._jobs = {}
+        self._queues = OrderedDict()
+        self._running = {}
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, user: str, fn, *args, **kwargs):
+        """
+        Encola un trabajo.
+
+        Retorna:
+          - El Job creado.
+
+        Lanza:
+          - QueueFullError si el usuario o la cola superan sus límites.
+        """
+        with self._condition:
+            self._prune()
+            queued = sum(len(queue) for queue in self._queues.values())
+            pending = len(self._queues.get(user, ())) + self._running.get(user, 0)
+            if pending >= self.max_queued_per_user:
+                raise QueueFullError(f"Ya tiene {pending} trabajos pendientes; espere a que termine alguno.")
+            if queued >= self.max_queued:
+                raise QueueFullError("La cola está llena; intente nuevamente en unos minutos.")
+            job = Job(user, fn, args, kwargs)
+            self._jobs[job.job_id] = job
+            self._queues.setdefault(user, deque()).append(job)
+            self._condition.notify()
+        return job
+
+    def get(self, job_id: str):
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        """
+        Cancela un trabajo: si está encolado se quita de la cola; si está en ejecución se marca como
+        cancelado y se llaman sus funciones de cancelación.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return
+            queue = self._queues.get(job.user)
+            if job.status == "queued" and queue is not None and job in queue:
+                queue.remove(job)
+                job.status = "cancelled"
+                job.finished_at = time.time()
+        job.cancel()
+
+    def position(self, job_id: str):
+        """
+        Retorna la posición aproximada del trabajo en la cola (0 si ya se está ejecutando o terminó),
+        considerando el turno de cada usuario.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "queued":
+                return 0
+            own = list(self._queues.get(job.user, ())).index(job)
+            # Por cada turno propio se atiende un trabajo de cada otro usuario con trabajos encolados;
+            # los usuarios anteriores en el orden de turno se atienden una vez más
+            users = list(self._queues)
+            ahead = set(users[:users.index(job.user)])
+            others = sum(min(len(queue), own + (user in ahead))
+                         for user, queue in self._queues.items() if user != job.user)
+            return own + others + 1
+
+    def status(self, job_id: str):
+        """
+        Retorna el estado del trabajo para mostrarlo en la página (o None si no existe).
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        now = time.time()
+        return {
+            "job_id": job.job_id,
+            "status": job.status,
+            "position": self.position(job_id),
+            "events": len(job.events),
+            "waited_s": round((job.started_at or now) - job.created_at, 1),
+            "elapsed_s": round((job.finished_at or now) - job.started_at, 1) if job.started_at else 0.0,
+            "error": job.error,
+        }
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "running": sum(self._running.values()),
+                "users": len(self._queues),
+            }
+
+    def _next_job(self):
+        # Primer usuario (en orden de turno) con trabajos encolados y cupo de ejecución
+        for user, queue in self._queues.items():
+            if queue and self._running.get(user, 0) < self.max_running_per_user:
+                job = queue.popleft()
+                self._queues.move_to_end(user)
+                if not queue:
+                    del self._queues[user]
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                self._running[job.user] = self._running.get(job.user, 0) + 1
+                job.status = "running"
+                job.started_at = time.time()
+
+            try:
+                job.result = job.fn(job, *job.args, **job.kwargs)
+                job.status = "cancelled" if job.cancelled else "done"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                with self._condition:
+                    self._running[job.user] -= 1
+                    if not self._running[job.user]:
+                        del self._running[job.user]
+                    # Puede haber trabajos del mismo usuario esperando su cupo
+                    self._condition.notify_all()
+
+    def _prune(self):
+        limit = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done and job.finished_at < limit]:
+            del self._jobs[job_id]
+
+
+class RecordingUI:
+    def __init__(self, job: Job, target: int = None):
+        """
+        Reemplazo de streamlit para los trabajos de JobQueue: registra cada llamada (markdown, code,
+        container, expander, etc.) en el trabajo, en lugar de dibujarla, para que la página la
+        reproduzca con replay_events en cada consulta de progreso. Los hilos de trabajo nunca llaman
+        a Streamlit.
+
+        Cada llamada verifica si el trabajo fue cancelado y en ese caso lanza JobCancelled.
+        """
+        self._job = job
+        self._target = target
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self._job.check_cancelled()
+            return RecordingUI(self._job, self._job.record(self._target, name, args, kwargs))
+        return call
+
+    def write_stream(self, stream, interval: float = 0.25):
+        """
+        Consume el generador (eso hace avanzar la generación) y registra su texto por partes, como
+        eventos 'append' sobre un elemento vacío, cada interval segundos: la página muestra el avance
+        mientras el modelo responde. replay_events une las partes de cada elemento.
+
+        Retorna:
+          - El texto completo.
+        """
+        placeholder = self.empty()
+        chunks = []
+        pending = []
+        last = time.monotonic()
+        for chunk in stream:
+            self._job.check_cancelled()
+            pending.append(str(chunk))
+            if time.monotonic() - last >= interval:
+                self._job.record(placeholder._target, "append", ("".join(pending),))
+                chunks += pending
+                pending = []
+                last = time.monotonic()
+        if pending:
+            self._job.record(placeholder._target, "append", ("".join(pending),))
+            chunks += pending
+        return "".join(chunks)
+
+    def __enter__(self):
+        self._job.record(self._target, "__enter__")
+        return self
+
+    def __exit__(self, *exc):
+        self._job.record(self._target, "__exit__")
+        return False
+
+
+def replay_events(events: list, ui):
+    """
+    Reproduce en Streamlit (ui) las llamadas registradas por RecordingUI.
+    """
+    elements = {None: ui}
+    # Texto acumulado de cada elemento que recibió partes de write_stream
+    texts = {}
+    for target, name, args, kwargs, result_id in events:
+        element = elements.get(target, ui)
+        if name == "append":
+            texts[target] = texts.get(target, "") + args[0]
+        elif name == "__enter__":
+            element.__enter__()
+        elif name == "__exit__":
+            element.__exit__(None, None, None)
+        elif name == "spinner":
+            # El trabajo ya avanzó: el spinner no aporta al reproducir
+            elements[result_id] = contextlib.nullcontext()
+        else:
+            elements[result_id] = getattr(element, name)(*args, **kwargs)
+    for target, text in texts.items():
+        elements.get(target, ui).markdown(text)
@@ -0,0 +1,131 @@
+import random
+import re
+import threading
+
+from app.context_builder import MODEL_TOKEN_BUDGETS, DEFAULT_TOKEN_BUDGET
+
+# Modelos ordenados del más rápido y barato al más capaz
+DEFAULT_MODEL_TIERS = ["llama3.1-70b", "mistral-large2", "claude-3-5-sonnet"]
+
+# Nivel inicial por tipo de tarea: el plan define todo lo demás y se genera una sola vez
+DEFAULT_TASK_TIERS = {"plan": 2, "code": 0}
+
+# Pasos que suelen requerir un modelo más capaz que un CREATE TABLE
+COMPLEX_STEP = re.compile(
+    r"\b(procedure|function|udf|javascript|python|task|stream|pipe|merge|dynamic table|"
+    r"masking|row access|policy|snowpark)\b",
+    re.IGNORECASE
+)
+
+
+class ModelRouter:
+    def __init__(self, models: list = None, task_tiers: dict = None, min_samples: int = 5,
+                 min_success_rate: float = 0.5, max_latency_ms: float = None, decay: float = 0.2,
+                 explore_rate: float = 0.1):
+        """
+        Elige el modelo de COMPLETE de cada llamada según la tarea, la complejidad del paso, el tamaño
+        del prompt y el número de intento, y ajusta la elección con las estadísticas observadas.
+
+        Los primeros intentos de pasos simples usan el modelo más rápido; cada reintento sube un
+        nivel. Un modelo cuya tasa de éxito reciente para la tarea cae bajo min_success_rate (o cuya
+        latencia reciente supera max_latency_ms) se salta y se usa el siguiente nivel.
+
+        Las estadísticas son promedios móviles exponenciales: pesan más las llamadas recientes. Un
+        modelo degradado igual se elige en una fracción explore_rate de las llamadas, para que sus
+        estadísticas se actualicen y pueda recuperarse si el problema era pasajero.
+
+        Parámetros:
+          - models: modelos ordenados del más rápido al más capaz.
+          - task_tiers: nivel inicial por tarea ('plan', 'code').
+          - min_samples: llamadas observadas antes de usar las estadísticas de un modelo.
+          - min_success_rate: tasa de éxito mínima para seguir usando un modelo en una tarea.
+          - max_latency_ms: latencia promedio máxima aceptada (None para no limitarla).
+          - decay: peso de cada nueva observación en los promedios (entre 0 y 1).
+          - explore_rate: probabilidad de elegir igual un modelo degradado.
+        """
+        self.models = models or DEFAULT_MODEL_TIERS
+        self.task_tiers = task_tiers or DEFAULT_TASK_TIERS
+        self.min_samples = min_samples
+        self.min_success_rate = min_success_rate
+        self.max_latency_ms = max_latency_ms
+        self.decay = decay
+        self.explore_rate = explore_rate
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def choose(self, task: str, prompt_tokens: int = 0, attempt: int = 1, step: str = None):
+        """
+        Retorna el modelo a usar en una llamada.
+
+        Parámetros:
+          - task: tipo de tarea ('plan' o 'code').
+          - prompt_tokens: tamaño estimado del prompt.
+          - attempt: número de intento del paso (cada reintento sube un nivel).
+          - step: descripción del paso, para detectar pasos complejos (procedimientos, tareas, etc.).
+        """
+        tier = self.task_tiers.get(task, len(self.models) - 1) + attempt - 1
+        if step and COMPLEX_STEP.search(step):
+            tier += 1
+        tier = min(tier, len(self.models) - 1)
+
+        for model in self.models[tier:-1]:
+            if prompt_tokens > MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET):
+                continue
+            if self.is_degraded(task, model) and self._random.random() >= self.explore_rate:
+                continue
+            return model
+        return self.models[-1]
+
+    def is_degraded(self, task: str, model: str):
+        """
+        Indica si las estadísticas recientes desaconsejan usar el modelo para la tarea.
+        """
+        with self._lock:
+            stats = self._stats.get((task, model))
+            if stats is None:
+                return False
+            if stats["outcomes"] >= self.min_samples and stats["success_rate"] < self.min_success_rate:
+                return True
+            return (self.max_latency_ms is not None and stats["latency_calls"] >= self.min_samples
+                    and stats["latency_ms"] > self.max_latency_ms)
+
+    def record(self, task: str, model: str, latency_ms: float = None, success: bool = None):
+        """
+        Registra la latencia y/o el resultado de una llamada.
+
+        Parámetros:
+          - task: tipo de tarea ('plan' o 'code').
+          - model: modelo usado.
+          - latency_ms: duración de la llamada a COMPLETE (None si la respuesta vino del cache).
+          - success: si el resultado fue útil (YAML válido, código ejecutado sin errores).
+        """
+        with self._lock:
+            stats = self._stats.setdefault((task, model), {"latency_ms": None, "latency_calls": 0,
+                                                           "success_rate": None, "outcomes": 0})
+            if latency_ms is not None:
+                stats["latency_ms"] = self._average(stats["latency_ms"], latency_ms)
+                stats["latency_calls"] += 1
+            if success is not None:
+                stats["success_rate"] = self._average(stats["success_rate"], 1.0 if success else 0.0)
+                stats["outcomes"] += 1
+
+    def _average(self, current: float, value: float):
+        return value if current is None else current + self.decay * (value - current)
+
+    def stats(self):
+        """
+        Retorna las estadísticas por tarea y modelo: llamadas, latencia y tasa de éxito recientes.
+        """
+        with self._lock:
+            items = sorted(self._stats.items())
+        return [
+            {
+                "task": task,
+                "model": model,
+                "calls": max(stats["latency_calls"], stats["outcomes"]),
+                "avg_latency_ms": round(stats["latency_ms"], 2) if stats["latency_ms"] is not None else None,
+                "success_rate": round(stats["success_rate"], 3) if stats["success_rate"] is not None else None,
+            }
+            for (task, model), stats in items
+        ]
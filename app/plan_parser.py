@@ -0,0 +1,275 @@
+import json
+import re
+import textwrap
+
+import yaml
+
+STEP_TYPES = ("sql_code", "documentation")
+
+# Inicio de un elemento de la lista 'steps' ('- step_name:', o cualquier otra clave si el modelo
+# cambió el orden); solo cuentan los elementos con la sangría del primero, no las listas internas
+STEP_START = re.compile(r"^([ \t]*)- [A-Za-z_]+:", re.MULTILINE)
+
+# Línea 'clave: valor' con el valor sin comillas (para citar valores que rompen el YAML)
+KEY_VALUE = re.compile(r"^(\s*(?:- )?[A-Za-z_]+:[ \t]+)(.+?)\s*$")
+
+# Tipos de objeto que se crean con SQL
+SQL_OBJECT_TYPES = re.compile(
+    r"\b(table|view|procedure|function|udf|task|stream|pipe|stage|schema|database|warehouse|role|"
+    r"sequence|policy|tag|user|grant|file format|integration|alert)\b",
+    re.IGNORECASE
+)
+
+
+class PlanStep:
+    __slots__ = ("step_name", "step_type", "long_step_description", "objective", "context",
+                 "object_name", "object_type", "repairs")
+
+    def __init__(self, step_name: str, step_type: str, long_step_description: str, objective: str = "",
+                 context: str = "", object_name: str = "", object_type: str = "", repairs: list = None):
+        """
+        Paso del plan validado contra el esquema esperado.
+
+        Parámetros:
+          - step_name, step_type, long_step_description, objective, context: campos del paso.
+          - object_name, object_type: objeto que crea o modifica el paso.
+          - repairs: descripción de las correcciones aplicadas al paso recibido.
+        """
+        self.step_name = step_name
+        self.step_type = step_type
+        self.long_step_description = long_step_description
+        self.objective = objective
+        self.context = context
+        self.object_name = object_name
+        self.object_type = object_type
+        self.repairs = repairs or []
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        Valida un paso parseado del YAML y corrige los problemas comunes (campos faltantes o que no
+        son texto, step_type ausente o con otro nombre).
+
+        Retorna:
+          - El PlanStep, o None si al paso le falta lo esencial (nombre y descripción).
+        """
+        if not isinstance(data, dict):
+            return None
+        repairs = []
+
+        def text(key):
+            value = data.get(key)
+            if value is None:
+                repairs.append(f"falta '{key}'")
+                return ""
+            if isinstance(value, str):
+                return value.strip()
+            repairs.append(f"'{key}' no es texto")
+            if isinstance(value, (list, dict)):
+                return yaml.safe_dump(value, allow_unicode=True, default_flow_style=True).strip()
+            return str(value)
+
+        step_name = text("step_name")
+        long_step_description = text("long_step_description")
+        if not step_name and not long_step_description:
+            return None
+        step_name = step_name or long_step_description[:60]
+        long_step_description = long_step_description or step_name
+
+        obj = data.get("object")
+        if not isinstance(obj, dict):
+            repairs.append("falta 'object'")
+            obj = {"name": obj} if isinstance(obj, str) else {}
+        object_name = str(obj.get("name") or "")
+        object_type = str(obj.get("type") or "")
+
+        step_type = cls.normalize_step_type(data.get("step_type"), object_type, long_step_description)
+        if step_type != data.get("step_type"):
+            repairs.append(f"step_type '{data.get('step_type')}' -> '{step_type}'")
+
+        return cls(step_name, step_type, long_step_description, text("objective"), text("context"),
+                   object_name, object_type, repairs)
+
+    @staticmethod
+    def normalize_step_type(step_type, object_type: str = "", description: str = ""):
+        """
+        Retorna un step_type válido: el recibido si lo es, uno equivalente (ej. 'sql' -> 'sql_code')
+        o uno inferido del tipo de objeto y la descripción.
+        """
+        value = str(step_type or "").strip().lower()
+        if value in STEP_TYPES:
+            return value
+        if "sql" in value or "code" in value:
+            return "sql_code"
+        if "doc" in value:
+            return "documentation"
+        if SQL_OBJECT_TYPES.search(object_type or "") or SQL_OBJECT_TYPES.search(description or ""):
+            return "sql_code"
+        return "documentation"
+
+    def to_dict(self):
+        """
+        Retorna el paso con la estructura del YAML original (la que usan generate_step_descriptions
+        y build_step_dependencies).
+        """
+        return {
+            "step_name": self.step_name,
+            "step_type": self.step_type,
+            "long_step_description": self.long_step_description,
+            "objective": self.objective,
+            "context": self.context,
+            "object": {"name": self.object_name, "type": self.object_type},
+        }
+
+
+def strip_fences(text: str):
+    """
+    Quita las líneas de delimitadores de bloque Markdown (```yaml, ```).
+    """
+    return "\n".join(line for line in text.split("\n") if not line.lstrip().startswith("```"))
+
+
+def quote_values(fragment: str):
+    """
+    Pone entre comillas los valores que rompen el YAML (p.ej. 'descripción: Crear tabla: x' o
+    valores que empiezan con caracteres reservados).
+    """
+    lines = []
+    for line in fragment.split("\n"):
+        match = KEY_VALUE.match(line)
+        if match:
+            prefix, value = match.groups()
+            if value[0] not in "\"'|>[{" and (": " in value or " #" in value or value[0] in "*&!%@`"):
+                line = prefix + json.dumps(value, ensure_ascii=False)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_step_fragment(fragment: str):
+    """
+    Parsea el fragmento YAML de un paso ('- step_name: ...'), intentando repararlo si no es válido.
+
+    Retorna:
+      - Tupla (PlanStep o None, mensaje de error o None).
+    """
+    fragment = textwrap.dedent(strip_fences(fragment).replace("\t", "  ")).strip("\n")
+    error = None
+    for candidate in (fragment, quote_values(fragment)):
+        try:
+            block = yaml.safe_load(candidate)
+        except yaml.YAMLError as e:
+            error = str(e)
+            continue
+        if isinstance(block, dict) and isinstance(block.get("steps"), list):
+            block = block["steps"]
+        if isinstance(block, list) and block:
+            block = block[0]
+        step = PlanStep.from_dict(block)
+        if step is not None:
+            if candidate is not fragment:
+                step.repairs.append("valores citados")
+            return step, None
+        error = "el paso no tiene nombre ni descripción"
+    return None, error
+
+
+class PlanParser:
+    def __init__(self):
+        """
+        Parsea el plan YAML a medida que llega del modelo: cada paso se valida y se entrega en cuanto
+        está completo (cuando empieza el siguiente o termina la respuesta), sin volver a parsear el
+        texto ya procesado.
+
+        Los pasos que no se pudieron reparar quedan en broken como (posición en steps, fragmento, error)
+        para pedir al modelo solo ese fragmento (ver SnowflakeAnswerService.repair_step).
+        """
+        self.text = ""
+        self.steps = []
+        self.broken = []
+        self._start = None
+        self._scan_from = 0
+        # Sangría de los elementos de la lista de pasos (la del primero)
+        self._indent = None
+
+    def feed(self, chunk: str):
+        """
+        Agrega un fragmento de la respuesta.
+
+        Retorna:
+          - Lista de los PlanStep que quedaron completos con este fragmento.
+        """
+        self.text += chunk
+        completed = []
+        # Se busca desde el inicio de la última línea revisada, por si quedó cortada
+        for match in STEP_START.finditer(self.text, self._scan_from):
+            if self._indent is None:
+                self._indent = match.group(1)
+            elif match.group(1) != self._indent:
+                continue
+            if self._start is not None and match.start() > self._start:
+                completed += self._add(self.text[self._start:match.start()])
+            self._start = match.start()
+        self._scan_from = max(self.text.rfind("\n") + 1, self._start + 1 if self._start is not None else 0)
+        return completed
+
+    def finish(self):
+        """
+        Indica que terminó la respuesta.
+
+        Retorna:
+          - Lista con los PlanStep completados al final (normalmente el último paso).
+        """
+        if self._start is not None:
+            completed = self._add(self.text[self._start:])
+            self._start = None
+            return completed
+        # Sin elementos de lista con clave (p.ej. YAML en estilo flujo): se parsea completo
+        try:
+            data = yaml.safe_load(strip_fences(self.text))
+        except yaml.YAMLError as e:
+            self.broken.append((0, self.text, str(e)))
+            return []
+        items = data.get("steps", []) if isinstance(data, dict) else data if isinstance(data, list) else []
+        if not isinstance(items, list) or not items:
+            # Ningún paso reconocible: se repara la respuesta completa en lugar de perderla
+            self.broken.append((len(self.steps), self.text, "no se encontraron pasos"))
+            return []
+        completed = []
+        for item in items:
+            step = PlanStep.from_dict(item)
+            if step is None:
+                self.broken.append((len(self.steps), yaml.safe_dump(item, allow_unicode=True), "paso inválido"))
+                continue
+            self.steps.append(step)
+            completed.append(step)
+        return completed
+
+    def _add(self, fragment: str):
+        step, error = parse_step_fragment(fragment)
+        if step is None:
+            # Se guarda la posición para insertar el paso reparado en su lugar
+            self.broken.append((len(self.steps), fragment, error))
+            return []
+        self.steps.append(step)
+        return [step]
+
+    def replace_broken(self, repaired: dict):
+        """
+        Inserta los pasos reparados en la posición de sus fragmentos originales.
+
+        Parámetros:
+          - repaired: diccionario {índice en broken: PlanStep} con los fragmentos que se pudieron reparar.
+        """
+        # De atrás hacia adelante para que las posiciones anteriores no se desplacen
+        for index in sorted(repaired, key=lambda i: (self.broken[i][0], i), reverse=True):
+            self.steps.insert(self.broken[index][0], repaired[index])
+        self.broken = [item for index, item in enumerate(self.broken) if index not in repaired]
+
+    def plan(self):
+        """
+        Retorna el plan con la estructura del YAML original ({'steps': [...]}).
+        """
+        return {"steps": [step.to_dict() for step in self.steps]}
+
+    def to_yaml(self):
+        return yaml.safe_dump(self.plan(), allow_unicode=True, sort_keys=False)
@@ -0,0 +1,107 @@
+import copy
+import time
+
+from app.cache import make_cache_key
+from app.completion_cache import CompletionCache
+
+
+class PlanStore:
+    def __init__(self, backend, enabled: bool = True, scope: str = None, ttl: float = 30 * 86400):
+        """
+        Guarda el plan YAML de cada idea y el resultado final de cada paso ejecutado con éxito, para
+        reanudar una ejecución interrumpida (rerun de Streamlit, caída del proceso) y, cuando el
+        usuario edita la idea, volver a generar solo los pasos cuyas entradas cambiaron.
+
+        Cada paso se identifica por una huella (fingerprint) de sus entradas: modelo, descripción,
+        filtros y el código de los pasos de los que depende. Si ninguna cambió, el paso ya está hecho.
+
+        Las claves incluyen el ámbito (scope, p.ej. usuario y base de datos): un paso hecho por un
+        usuario, o en otra base de datos, no se da por hecho para otro. Las entradas expiran tras ttl
+        segundos, porque los objetos creados pueden borrarse fuera de la app.
+
+        Parámetros:
+          - backend: almacenamiento de las entradas (SQLiteCache o SnowflakeTableCache).
+          - enabled: permite desactivar el almacenamiento sin quitarlo de los servicios.
+          - scope: ámbito de las claves (ver with_scope).
+          - ttl: segundos de vida de los planes y pasos guardados (None para usar el del backend).
+        """
+        self.backend = backend
+        self.enabled = enabled
+        self.scope = scope
+        self.ttl = ttl
+
+    def with_scope(self, scope: str):
+        """
+        Retorna una copia del almacenamiento cuyas claves quedan limitadas al ámbito indicado
+        (p.ej. 'usuario|base de datos'); comparte el backend.
+        """
+        store = copy.copy(self)
+        store.scope = scope
+        return store
+
+    def plan_key(self, model: str, query: str, filter_: dict):
+        return make_cache_key("plan", self.scope, model, CompletionCache.normalize_prompt(query), filter_)
+
+    def get_plan(self, plan_key: str):
+        """
+        Retorna el YAML guardado para el plan, o None si no existe.
+        """
+        if not self.enabled:
+            return None
+        record = self.backend.get(plan_key)
+        return record["plan"] if record else None
+
+    def save_plan(self, plan_key: str, query: str, plan_yaml: str):
+        if not self.enabled:
+            return
+        self.backend.set(plan_key, {"query": query, "plan": plan_yaml, "saved_at": time.time()}, self.ttl)
+
+    def discard_plan(self, plan_key: str):
+        """
+        Olvida el plan guardado (p.ej. para generarlo de nuevo); los pasos se conservan.
+        """
+        if self.enabled:
+            self.backend.set(plan_key, None)
+
+    def step_fingerprint(self, model: str, step: str, dependency_steps: list, filter_: dict):
+        """
+        Calcula la huella de las entradas de un paso.
+
+        Parámetros:
+          - model: modelo usado para generar el código.
+          - step: descripción del paso.
+          - dependency_steps: lista de (índice, código) de los pasos de los que depende, en orden de
+            índice. No deben incluirse otros pasos: en paralelo, cuáles ya terminaron depende del momento.
+          - filter_: filtros de la búsqueda de contexto.
+        """
+        return make_cache_key("step", self.scope, model, step, [code for _, code in dependency_steps], filter_)
+
+    def get_step(self, fingerprint: str):
+        """
+        Retorna el registro guardado del paso ({idx, sql_codes, outputs, attempts, saved_at}) o None.
+        """
+        if not self.enabled:
+            return None
+        return self.backend.get(fingerprint)
+
+    def save_step(self, fingerprint: str, result, outputs: list):
+        """
+        Guarda el código final de un paso ejecutado con éxito y el resultado de cada sentencia.
+
+        Parámetros:
+          - fingerprint: huella del paso (ver step_fingerprint).
+          - result: StepResult del paso.
+          - outputs: lista de (resultado, éxito) de las sentencias del último intento.
+        """
+        if not self.enabled:
+            return
+        self.backend.set(fingerprint, {
+            "idx": result.idx,
+            "sql_codes": result.sql_codes,
+            "outputs": [str(output) for output, _ in outputs],
+            "attempts": result.attempts,
+            "saved_at": time.time(),
+        }, self.ttl)
+
+    def stats(self):
+        return self.backend.stats()
@@ -1,4 +1,10 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
 import streamlit as st
+from snowflake.snowpark import Session
 
 
 class snowflake_session():
@@ -9,3 +15,176 @@ class snowflake_session():
         conn = st.connection(self.conn_name)
         session = conn.session()
         return session
+
+    def config(self):
+        """
+        Retorna la configuración de la conexión (cuenta, rol, warehouse, base de datos, etc.).
+        """
+        return dict(st.secrets["connections"][self.conn_name])
+
+    def new_session(self):
+        """
+        Crea una sesión nueva e independiente con la configuración de la conexión.
+        Útil para ejecutar pasos en paralelo sin compartir la sesión de st.connection.
+        """
+        return Session.builder.configs(self.config()).create()
+
+
+# Contexto de la sesión que el SQL generado puede cambiar (USE ROLE, USE WAREHOUSE, etc.)
+SESSION_CONTEXT = ("ROLE", "WAREHOUSE", "DATABASE", "SCHEMA")
+
+
+def quote_identifier(name: str):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SnowflakeSessionPool:
+    def __init__(self, sf_session: snowflake_session, size: int = 4, health_check_interval: float = 300):
+        """
+        Pool de sesiones de Snowflake reutilizables entre ejecuciones y usuarios.
+
+        El SQL generado corre en estas sesiones y puede cambiar su contexto (USE ROLE, USE DATABASE,
+        variables de sesión). Al devolver una sesión se restaura el rol, warehouse, base de datos y
+        esquema que tenía al crearse y se eliminan sus variables; si no se puede, la sesión se cierra
+        en lugar de entregarse a otro usuario.
+
+        Parámetros:
+          - sf_session: instancia de snowflake_session usada para crear sesiones nuevas.
+          - size: número máximo de sesiones abiertas a la vez.
+          - health_check_interval: segundos sin usar tras los cuales se valida la sesión con SELECT 1
+            antes de entregarla.
+        """
+        self.sf_session = sf_session
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        # Contexto inicial de cada sesión creada (id de la sesión -> {ROLE, WAREHOUSE, ...})
+        self._contexts = {}
+
+    @staticmethod
+    def _context(session):
+        row = session.sql(
+            "SELECT CURRENT_ROLE() AS ROLE, CURRENT_WAREHOUSE() AS WAREHOUSE, "
+            "CURRENT_DATABASE() AS DATABASE, CURRENT_SCHEMA() AS SCHEMA"
+        ).collect()[0]
+        return {kind: row[kind] for kind in SESSION_CONTEXT}
+
+    def _restore(self, session):
+        """
+        Devuelve la sesión a su contexto inicial. Retorna False si no se pudo (o si no se conoce).
+        """
+        initial = self._contexts.get(id(session))
+        if initial is None:
+            return False
+        try:
+            current = self._context(session)
+            for kind in SESSION_CONTEXT:
+                if current[kind] == initial[kind]:
+                    continue
+                if initial[kind] is None:
+                    # No hay USE que vuelva a "sin warehouse/base de datos"
+                    return False
+                name = quote_identifier(initial[kind])
+                if kind == "SCHEMA":
+                    name = f"{quote_identifier(initial['DATABASE'])}.{name}"
+                session.sql(f"USE {kind} {name}").collect()
+            for row in session.sql("SHOW VARIABLES").collect():
+                session.sql(f"UNSET {quote_identifier(row['name'])}").collect()
+            return True
+        except Exception:
+            return False
+
+    def _is_healthy(self, session):
+        try:
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, session):
+        with self._lock:
+            self._created -= 1
+            self._contexts.pop(id(session), None)
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: float = None):
+        """
+        Toma una sesión del pool. Si no hay sesiones libres y no se alcanzó el tamaño máximo se crea
+        una nueva; si se alcanzó, espera a que otra ejecución devuelva la suya.
+
+        Parámetros:
+          - timeout: segundos máximos de espera (None para esperar indefinidamente).
+
+        Retorna:
+          - Una sesión de Snowpark lista para usar. Lanza queue.Empty si se agota el tiempo de espera.
+        """
+        while True:
+            try:
+                session, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    session = None
+                    try:
+                        session = self.sf_session.new_session()
+                        context = self._context(session)
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        if session is not None:
+                            session.close()
+                        raise
+                    with self._lock:
+                        self._contexts[id(session)] = context
+                    return session
+                session, last_used = self._idle.get(timeout=timeout)
+
+            if session is None:
+                # Se cerró una sesión prestada: hay cupo para crear otra
+                continue
+            if time.time() - last_used < self.health_check_interval or self._is_healthy(session):
+                return session
+            self._discard(session)
+
+    def release(self, session):
+        """
+        Devuelve una sesión al pool para que la reutilice otra ejecución, con su contexto inicial
+        restaurado; si no se puede restaurar, la sesión se cierra.
+        """
+        if not self._restore(session):
+            self._discard(session)
+            # Despierta a quien espere una sesión para que cree otra en su lugar
+            self._idle.put((None, 0))
+            return
+        self._idle.put((session, time.time()))
+
+    @contextmanager
+    def session(self, timeout: float = None):
+        """
+        Presta una sesión del pool durante el bloque with y la devuelve al terminar.
+        """
+        session = self.acquire(timeout)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def close(self):
+        """
+        Cierra todas las sesiones libres del pool.
+        """
+        while True:
+            try:
+                session, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if session is not None:
+                self._discard(session)
@@ -1,9 +1,16 @@
+import copy
+import time
+
 from snowflake.core import Root
+from app.cortex_client import CortexClient
 from app.cortex_search_service import CortexSearchService
+from app.completion_cache import CompletionCache
+from app.context_builder import estimate_tokens
 
 
 class SnowflakeAnswerService:
-    def __init__(self, session, cortex_search_service: CortexSearchService, model: str = 'claude-3-5-sonnet'):
+    def __init__(self, session, cortex_search_service: CortexSearchService, model: str = 'claude-3-5-sonnet',
+                 completion_cache: CompletionCache = None, options: dict = None, router=None):
         """
         Inicializa el objeto SnowflakeAnswerService.
 
@@ -11,12 +18,30 @@ class SnowflakeAnswerService:
           - session: objeto de sesión de Snowflake.
           - cortex_search_service: instancia de CortexSearchService para generar el contexto.
           - model: nombre del modelo a utilizar en COMPLETE (puedes cambiarlo según tus necesidades).
+          - completion_cache: cache opcional de respuestas de COMPLETE compartido entre servicios.
+          - options: opciones de COMPLETE (p.ej. {"max_tokens": 8192, "temperature": 0}).
+          - router: ModelRouter opcional que elige el modelo del plan en lugar de model.
         """
         self.session = session
         self.cortex_search_service = cortex_search_service
+        self.completion_cache = completion_cache
+        self.cortex = CortexClient(session, completion_cache=completion_cache, options=options)
         self.model = model  # <-- AQUI PUEDES SELECCIONAR EL MODELO QUE DESEES
+        self.router = router
+        # Modelo usado en la última respuesta (para registrar su resultado en el router)
+        self.last_model = model
+
+    def with_session(self, session):
+        """
+        Retorna una copia del servicio que usa otra sesión de Snowflake
+        (comparte el servicio de búsqueda y el cache de respuestas).
+        """
+        service = copy.copy(self)
+        service.session = session
+        service.cortex = self.cortex.with_session(session)
+        return service
 
-    def generate_answer(self, user_question: str, filter_: dict, limit: int = 10):
+    def generate_answer(self, user_question: str, filter_: dict, limit: int = 10, use_cache: bool = True):
         """
         Genera una respuesta completa a partir de la pregunta del usuario.
 
@@ -24,10 +49,63 @@ class SnowflakeAnswerService:
           - user_question: la pregunta del usuario.
           - filter_: diccionario de filtros para la búsqueda de contexto.
           - limit: número máximo de resultados a retornar para el contexto (por defecto 10).
+          - use_cache: si es False se ignora el cache de respuestas de COMPLETE.
 
         Retorna:
           - La respuesta generada por el modelo de completado.
         """
+        prompt = self.build_prompt(user_question, filter_, limit)
+        model = self.choose_model(prompt)
+
+        # Llama a la función que realiza el completado de texto utilizando el modelo seleccionado
+        start = time.perf_counter()
+        stats = {}
+        answer = self.complete_text(prompt, use_cache=use_cache, model=model, stats=stats)
+        # Una respuesta del cache no mide la latencia del modelo
+        if self.router is not None and not stats.get("cached"):
+            self.router.record("plan", model, latency_ms=(time.perf_counter() - start) * 1000)
+        return answer
+
+    def generate_answer_stream(self, user_question: str, filter_: dict, limit: int = 10, use_cache: bool = True):
+        """
+        Igual que generate_answer, pero retorna un generador con los fragmentos de la respuesta
+        a medida que el modelo los produce (p.ej. para usar con st.write_stream).
+        """
+        prompt = self.build_prompt(user_question, filter_, limit)
+        model = self.choose_model(prompt)
+        if self.router is None:
+            return self.stream_text(prompt, use_cache=use_cache, model=model)
+
+        def timed():
+            start = time.perf_counter()
+            stats = {}
+            yield from self.stream_text(prompt, use_cache=use_cache, model=model, stats=stats)
+            if not stats.get("cached"):
+                self.router.record("plan", model, latency_ms=(time.perf_counter() - start) * 1000)
+
+        return timed()
+
+    def choose_model(self, prompt: str):
+        """
+        Elige el modelo del plan con el router (si hay) y lo guarda en last_model.
+        """
+        self.last_model = self.router.choose("plan", estimate_tokens(prompt)) if self.router else self.model
+        return self.last_model
+
+    def record_outcome(self, success: bool):
+        """
+        Registra en el router si el último plan generado fue válido.
+        """
+        if self.router is not None:
+            self.router.record("plan", self.last_model, success=success)
+
+    def build_prompt(self, user_question: str, filter_: dict, limit: int = 10):
+        """
+        Construye el prompt de planificación con el contexto de Cortex Search.
+
+        Retorna:
+          - El prompt completo (sin escapar).
+        """
         # Genera el contexto a partir del servicio Cortex Search
         context = self.cortex_search_service.generate_context(user_question, filter_, limit)
 
@@ -66,36 +144,60 @@ class SnowflakeAnswerService:
           f"{user_question}\n\n"
           "<<< END OF PROMPT CONFIGURATION >>>"
         )
+        return prompt
 
-        # Llama a la función que realiza el completado de texto utilizando el modelo seleccionado
-        answer = self.complete_text(prompt)
-        return answer
+    def repair_step(self, user_question: str, fragment: str, error: str, use_cache: bool = True):
+        """
+        Pide al modelo que corrija solo el fragmento YAML de un paso que no se pudo parsear, en lugar
+        de regenerar el plan completo.
 
-    def format_prompt(self, prompt: str):
-        prompt = prompt.replace("'", "''")
-        return prompt
+        Parámetros:
+          - user_question: la idea del usuario (contexto del plan).
+          - fragment: texto del paso tal como lo generó el modelo.
+          - error: error del parser.
+          - use_cache: si es False se ignora el cache de respuestas de COMPLETE.
+
+        Retorna:
+          - El texto YAML corregido del paso.
+        """
+        prompt = (
+          "The following YAML fragment is one step of a plan to implement a user's idea in Snowflake, "
+          "but it is not valid YAML or it is missing fields.\n\n"
+          "Rewrite ONLY this step as a valid YAML list item with exactly these keys: step_name, step_type "
+          "(sql_code or documentation), long_step_description, objective, context, object (with name and type). "
+          "Quote values that contain ':' characters. Return only the YAML, without any additional text.\n\n"
+          f"User's Idea:\n{user_question}\n\n"
+          f"Parser error:\n{error}\n\n"
+          f"Fragment:\n{fragment}\n"
+        )
+        return self.complete_text(prompt, use_cache=use_cache, model=self.last_model)
 
-    def complete_text(self, prompt: str):
+    def complete_text(self, prompt: str, use_cache: bool = True, model: str = None, stats: dict = None):
         """
         Llama a la función COMPLETE de Snowflake para generar una respuesta a partir del prompt.
 
         Parámetros:
           - prompt: la cadena que contiene el prompt completo (incluyendo contexto y pregunta).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - model: modelo a usar en lugar del configurado.
+          - stats: diccionario opcional (ver CortexClient.complete).
 
         Retorna:
           - La respuesta generada por el modelo.
         """
+        return self.cortex.complete(model or self.model, prompt, use_cache=use_cache, stats=stats)
 
-        # Construye la consulta para llamar a la función COMPLETE.
-        # Nota: Asegúrate de formatear correctamente la consulta para evitar problemas con comillas o caracteres especiales.
-
-        prompt = self.format_prompt(prompt)
-        query = (
-            f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{self.model}', '{prompt}') AS response"
-        )
+    def stream_text(self, prompt: str, use_cache: bool = True, model: str = None, stats: dict = None):
+        """
+        Llama a COMPLETE en modo streaming y entrega la respuesta por fragmentos.
 
-        # Ejecuta la consulta a través de la sesión de Snowflake
-        result = self.session.sql(query).collect()[0]['RESPONSE']
+        Parámetros:
+          - prompt: la cadena que contiene el prompt completo (incluyendo contexto y pregunta).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - model: modelo a usar en lugar del configurado.
+          - stats: diccionario opcional (ver CortexClient.complete).
 
-        # Se asume que la respuesta viene en el campo 'response'
-        return result
+        Retorna:
+          - Un generador de fragmentos de texto. Si la respuesta está en cache se entrega completa.
+        """
+        return self.cortex.stream(model or self.model, prompt, use_cache=use_cache, stats=stats)
@@ -1,9 +1,132 @@
+import copy
+import re
+import threading
+import time
+import weakref
+
 from snowflake.core import Root
+from app.cortex_client import CortexClient
 from app.cortex_search_service import CortexSearchService
+from app.completion_cache import CompletionCache
+from app.concurrency import limits
+from app.context_builder import estimate_tokens, truncate_to_tokens
+from app.sql_splitter import split_sql as split_statements
+from app.tracing import tracer
+
+# Resultado mostrado para las sentencias que no retornan filas
+NO_ROWS = "Sentencia ejecutada correctamente (sin filas)."
+
+# Resultado de las sentencias de un lote fallido que sí se ejecutaron (sus filas ya no se obtienen)
+EXECUTED_IN_BATCH = "Sentencia ejecutada correctamente antes de la que falló en el lote."
+
+# Identificadores de consulta de Snowflake (se insertan en el texto de las consultas de control)
+QUERY_ID = re.compile(r"^[0-9a-fA-F-]+$")
+
+
+class MultiStatementJob:
+    def __init__(self, connection, statements: list):
+        """
+        Lote de sentencias enviado de forma asíncrona con el modo multi-statement del conector
+        (execute_async con num_statements). Tiene la interfaz del AsyncJob de Snowpark (query_id,
+        is_done, cancel, result) para usarlo con wait_query y cancel_running_queries.
+
+        Parámetros:
+          - connection: conexión del conector de Snowflake (session.connection).
+          - statements: lista de sentencias SQL (sin el ';' final).
+        """
+        self.connection = connection
+        self.statements = statements
+        # Identificadores de las sentencias del lote (consultas hijas), en orden
+        self.query_ids = []
+        self.cursor = connection.cursor()
+        # Cada ';' va en su propia línea para que un comentario '--' o '//' al final de una
+        # sentencia no lo oculte
+        try:
+            self.cursor.execute_async("\n;\n".join(statements), num_statements=len(statements))
+        except Exception:
+            self.cursor.close()
+            raise
+        self.query_id = self.cursor.sfqid
+
+    def is_done(self):
+        return not self.connection.is_still_running(self.connection.get_query_status(self.query_id))
+
+    def cancel(self):
+        self._control_query(f"SELECT SYSTEM$CANCEL_QUERY('{self.query_id}')")
+
+    def result(self):
+        """
+        Espera el lote y retorna una tupla (resultado, éxito) por sentencia. Si alguna falló, lanza
+        el error del lote (ver failed_results).
+        """
+        try:
+            self.connection.get_query_status_throw_if_error(self.query_id)
+            self.cursor.get_results_from_sfqid(self.query_id)
+            results = []
+            while True:
+                self.query_ids.append(self.cursor.sfqid)
+                rows = self.cursor.fetchall()
+                results.append((rows[0] if rows else NO_ROWS, True))
+                if len(results) == len(self.statements) or not self.cursor.nextset():
+                    break
+            return results
+        finally:
+            self.cursor.close()
+
+    def failed_results(self, error: Exception):
+        """
+        Resultado por sentencia de un lote que falló (o se canceló).
+
+        Snowflake reporta la falla de la sentencia k como falla del lote, pero las sentencias 1..k-1 ya
+        se ejecutaron y sus efectos permanecen. El estado de cada consulta hija se obtiene del
+        historial de la sesión para asignar el error a la sentencia que realmente falló.
+
+        Retorna:
+          - Lista de tuplas (resultado, éxito), una por sentencia.
+        """
+        self.cursor.close()
+        try:
+            children = self._control_query(
+                "SELECT query_id, execution_status, error_message "
+                "FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 1000)) child "
+                "WHERE child.start_time >= (SELECT start_time "
+                "FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 1000)) "
+                f"WHERE query_id = '{self.query_id}') "
+                f"AND child.query_id <> '{self.query_id}' AND child.execution_status <> 'RUNNING' "
+                f"ORDER BY child.start_time LIMIT {len(self.statements)}"
+            )
+        except Exception:
+            children = []
+        if not children:
+            return [(f"El lote falló y no se pudo identificar la sentencia: {error}", False)] * len(self.statements)
+
+        results = []
+        for query_id, status, message in children:
+            self.query_ids.append(query_id)
+            if status != "SUCCESS":
+                results.append((f"Error al ejecutar la consulta: {message or error}", False))
+                break
+            results.append((EXECUTED_IN_BATCH, True))
+        if results[-1][1] and len(results) < len(self.statements):
+            # La sentencia que falló aún no figura en el historial: es la siguiente a las exitosas
+            results.append((f"Error al ejecutar la consulta: {error}", False))
+        skipped = len(self.statements) - len(results)
+        return results + [("No se ejecutó: falló una sentencia anterior del lote.", False)] * skipped
+
+    def _control_query(self, sql_code: str):
+        if not QUERY_ID.match(self.query_id or ""):
+            raise ValueError(f"Identificador de consulta inválido: {self.query_id}")
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql_code)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
 
 
 class SnowflakeCodeGenerator:
-    def __init__(self, session, cortex_search_service: CortexSearchService, model: str = 'claude-3-5-sonnet'):
+    def __init__(self, session, cortex_search_service: CortexSearchService, model: str = 'claude-3-5-sonnet',
+                 completion_cache: CompletionCache = None, options: dict = None, router=None):
         """
         Inicializa el objeto SnowflakeCodeGenerator.
 
@@ -11,12 +134,39 @@ class SnowflakeCodeGenerator:
           - session: objeto de sesión de Snowflake.
           - cortex_search_service: instancia de CortexSearchService para generar el contexto.
           - model: nombre del modelo a utilizar en COMPLETE (puedes modificarlo según tus necesidades).
+          - completion_cache: cache opcional de respuestas de COMPLETE compartido entre servicios.
+          - options: opciones de COMPLETE (p.ej. {"max_tokens": 2048, "temperature": 0}).
+          - router: ModelRouter opcional que elige el modelo de cada intento (ver StepRunner).
         """
         self.session = session
         self.cortex_search_service = cortex_search_service
+        self.completion_cache = completion_cache
+        self.cortex = CortexClient(session, completion_cache=completion_cache, options=options)
         self.model = model  # Selecciona el modelo deseado
+        self.router = router
+        # Consultas asíncronas en curso (query_id -> AsyncJob), para poder cancelarlas
+        self.running_jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._children = weakref.WeakSet()
+
+    def with_session(self, session):
+        """
+        Retorna una copia del generador que usa otra sesión de Snowflake
+        (comparte el servicio de búsqueda y el cache de respuestas).
+        Las consultas en curso de la copia también se cancelan con cancel_running_queries del original.
+        """
+        generator = copy.copy(self)
+        generator.session = session
+        generator.cortex = self.cortex.with_session(session)
+        generator.running_jobs = {}
+        generator._jobs_lock = threading.Lock()
+        generator._children = weakref.WeakSet()
+        self._children.add(generator)
+        return generator
 
-    def generate_code(self, user_request: str, filter_: dict, limit: int = 10):
+    def generate_code(self, user_request: str, filter_: dict, limit: int = 10, use_cache: bool = True,
+                      search_token_budget: int = None, context: str = None, options: dict = None,
+                      model: str = None, stats: dict = None, search_query: str = None):
         """
         Genera código SQL para Snowflake basado en la solicitud del usuario.
 
@@ -24,12 +174,54 @@ class SnowflakeCodeGenerator:
           - user_request: la cadena que contiene la solicitud del usuario.
           - filter_: diccionario de filtros para la búsqueda de contexto.
           - limit: número máximo de resultados a retornar para el contexto (por defecto 10).
+          - use_cache: si es False se ignora el cache de respuestas de COMPLETE.
+          - search_token_budget: tokens máximos (estimados) del contexto de Cortex Search.
+          - context: contexto de Cortex Search ya obtenido (p.ej. con generate_context_many);
+            si se indica no se hace la búsqueda.
+          - options: opciones de COMPLETE para esta llamada (p.ej. {"temperature": 0.7}).
+          - model: modelo a usar en lugar del configurado.
+          - stats: diccionario opcional donde se guarda el tamaño estimado del prompt (ver build_prompt)
+            y si la respuesta vino del cache ('cached').
+          - search_query: texto a buscar en Cortex Search en lugar de user_request (p.ej. la
+            descripción del paso, que no cambia entre reintentos y mantiene la clave del cache de búsqueda).
 
         Retorna:
           - El código SQL generado por el modelo.
         """
-        # Genera el contexto usando CortexSearchService
-        context = self.cortex_search_service.generate_context(user_request, filter_, limit)
+        prompt = self.build_prompt(user_request, filter_, limit, search_token_budget, context, stats, search_query)
+
+        # Llama al método que invoca la función COMPLETE en Snowflake
+        sql_code = self.complete_text(prompt, use_cache=use_cache, options=options, model=model, stats=stats)
+        return self.strip_code_fences(sql_code)
+
+    def generate_code_stream(self, user_request: str, filter_: dict, limit: int = 10, use_cache: bool = True,
+                             search_token_budget: int = None, context: str = None, model: str = None,
+                             stats: dict = None, search_query: str = None):
+        """
+        Igual que generate_code, pero retorna un generador con los fragmentos del código a medida
+        que el modelo los produce. El texto crudo puede incluir los bloques ```sql; al terminar
+        se debe limpiar con strip_code_fences.
+        """
+        prompt = self.build_prompt(user_request, filter_, limit, search_token_budget, context, stats, search_query)
+        return self.stream_text(prompt, use_cache=use_cache, model=model, stats=stats)
+
+    def build_prompt(self, user_request: str, filter_: dict, limit: int = 10, search_token_budget: int = None,
+                     context: str = None, stats: dict = None, search_query: str = None):
+        """
+        Construye el prompt de generación de código con el contexto de Cortex Search.
+        Si se indica stats, guarda en él el tamaño estimado del prompt (prompt_tokens, request_tokens,
+        search_tokens). Es un diccionario por llamada: los pasos y candidatos en paralelo comparten
+        el generador. La búsqueda usa search_query si se indica, o si no user_request.
+
+        Retorna:
+          - El prompt completo (sin escapar).
+        """
+        if context is None:
+            # Genera el contexto usando CortexSearchService
+            context = self.cortex_search_service.generate_context(search_query or user_request, filter_, limit,
+                                                                  max_tokens=search_token_budget)
+        elif search_token_budget is not None:
+            context = truncate_to_tokens(context, search_token_budget)
 
         # Configura el prompt para que el modelo genere código SQL válido para Snowflake.
         prompt = (
@@ -61,32 +253,153 @@ class SnowflakeCodeGenerator:
                 "```\n"
                 "<<< END OF PROMPT CONFIGURATION >>>"
             )
-        # Llama al método que invoca la función COMPLETE en Snowflake
-        sql_code = self.complete_text(prompt)
-        sql_code = sql_code.replace("```sql", "").replace("```", "").strip()
-        return sql_code
+        if stats is not None:
+            stats.update(
+                prompt_tokens=estimate_tokens(prompt),
+                request_tokens=estimate_tokens(user_request),
+                search_tokens=estimate_tokens(context),
+            )
+        return prompt
 
-    def run_query(self, sql_code: str):
+    def strip_code_fences(self, sql_code: str):
+        """
+        Quita los delimitadores de bloque de código Markdown de la respuesta del modelo.
+        """
+        return sql_code.replace("```sql", "").replace("```", "").strip()
+
+    def run_query(self, sql_code: str, timeout: float = None):
         """
         Ejecuta una consulta en Snowflake.
 
         Parámetros:
           - sql_code: la consulta SQL a ejecutar.
+          - timeout: segundos máximos de ejecución; al superarlos la consulta se cancela, en lugar de
+            bloquear indefinidamente.
+
+        La consulta se envía siempre de forma asíncrona: queda en running_jobs (se puede cancelar) y
+        su query_id en el tracing.
         """
         print('CODIGO SQL:', sql_code)  # Para depuración
-        try:
-            result = self.session.sql(sql_code).collect()[0]
-            success = True
-        except Exception as e:
-            result = f"Error al ejecutar la consulta: {e}"
-            success = False
+        with tracer.span("run_query", sql_chars=len(sql_code)) as span:
+            try:
+                with limits.slot("execute"):
+                    job = self.submit_query(sql_code)
+                    span["query_id"] = job.query_id
+                    rows = self.wait_query(job, timeout=timeout)
+                result = rows[0] if rows else NO_ROWS
+                success = True
+            except Exception as e:
+                result = f"Error al ejecutar la consulta: {e}"
+                success = False
+            span["success"] = success
         return result, success
 
-    def format_prompt(self, prompt: str):
+    def run_queries(self, statements: list, timeout: float = None):
+        """
+        Ejecuta las sentencias de un paso en un solo viaje a Snowflake, usando el modo
+        multi-statement del conector (num_statements), y obtiene el resultado de cada una.
+
+        El lote se envía de forma asíncrona y queda registrado en running_jobs, así que
+        cancel_running_queries también lo detiene. Snowflake ejecuta las sentencias en orden y se
+        detiene en la primera que falla: las anteriores se reportan como ejecutadas y las
+        siguientes como no ejecutadas (ver MultiStatementJob.failed_results). Si la sesión no expone
+        la conexión del conector, o hay una sola sentencia, se ejecutan una por una con run_query.
+
+        Parámetros:
+          - statements: lista de sentencias SQL (sin el ';' final).
+          - timeout: segundos máximos para todo el lote.
+
+        Retorna:
+          - Lista de tuplas (resultado, éxito), una por sentencia.
+        """
+        connection = getattr(self.session, "connection", None)
+        if len(statements) <= 1 or connection is None:
+            return [self.run_query(sql_code, timeout=timeout) for sql_code in statements]
+
+        with tracer.span("run_queries", statements=len(statements),
+                         sql_chars=sum(map(len, statements))) as span:
+            with limits.slot("execute"):
+                try:
+                    job = MultiStatementJob(connection, statements)
+                except Exception as e:
+                    # Igual que run_query: el error del envío vuelve como resultado y no corta el paso
+                    span.update(error=str(e)[:500], success=False)
+                    return [(f"Error al ejecutar la consulta: {e}", False)] * len(statements)
+                with self._jobs_lock:
+                    self.running_jobs[job.query_id] = job
+                span["query_id"] = job.query_id
+                try:
+                    results = self.wait_query(job, timeout=timeout)
+                except Exception as e:
+                    results = job.failed_results(e)
+            span.update(query_ids=job.query_ids, success=all(success for _, success in results))
+        return results
+
+    def submit_query(self, sql_code: str):
+        """
+        Envía una consulta de forma asíncrona (collect_nowait) sin esperar su resultado.
+
+        Retorna:
+          - El AsyncJob de Snowpark; su query_id queda registrado en running_jobs.
+        """
+        job = self.session.sql(sql_code).collect_nowait()
+        with self._jobs_lock:
+            self.running_jobs[job.query_id] = job
+        return job
+
+    def wait_query(self, job, timeout: float = None, poll_interval: float = 0.1, max_poll_interval: float = 2.0):
+        """
+        Espera el resultado de una consulta asíncrona consultando su estado con backoff exponencial.
+
+        Parámetros:
+          - job: AsyncJob retornado por submit_query.
+          - timeout: segundos máximos de espera; al superarlos la consulta se cancela.
+          - poll_interval: espera inicial entre consultas de estado.
+          - max_poll_interval: espera máxima entre consultas de estado.
+
+        Retorna:
+          - Las filas resultantes de la consulta.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            if deadline is None:
+                # Sin tiempo máximo no hace falta consultar el estado: result() espera a que termine
+                return job.result()
+            while not job.is_done():
+                if deadline is not None and time.monotonic() >= deadline:
+                    job.cancel()
+                    raise TimeoutError(f"La consulta {job.query_id} superó el tiempo máximo de {timeout} segundos")
+                wait = poll_interval
+                if deadline is not None:
+                    wait = min(wait, max(deadline - time.monotonic(), 0))
+                time.sleep(wait)
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+            return job.result()
+        finally:
+            with self._jobs_lock:
+                self.running_jobs.pop(job.query_id, None)
+
+    def cancel_running_queries(self):
         """
-        Realiza el formateo necesario del prompt para evitar errores con comillas.
+        Cancela todas las consultas asíncronas en curso (SQL generado y COMPLETE) de este generador y
+        de sus copias (with_session).
+
+        Retorna:
+          - La lista de query_id cancelados.
         """
-        return prompt.replace("'", "''")
+        with self._jobs_lock:
+            jobs = list(self.running_jobs.items())
+            self.running_jobs.clear()
+        cancelled = self.cortex.cancel_running_queries()
+        for query_id, job in jobs:
+            try:
+                job.cancel()
+                cancelled.append(query_id)
+            except Exception:
+                pass
+        for child in list(self._children):
+            cancelled += child.cancel_running_queries()
+        return cancelled
 
     def split_sql(self, sql_code: str):
         """
@@ -95,29 +408,82 @@ class SnowflakeCodeGenerator:
         Parámetros:
           - sql_code: el código SQL a dividir.
 
+        Respeta los ';' dentro de literales, comentarios y cuerpos $$ ... $$, y conserva la última
+        instrucción aunque no termine en ';'.
+
         Retorna:
           - Una lista de instrucciones SQL individuales.
         """
-        return sql_code.split(";")[:-1]
+        return split_statements(sql_code)
 
-    def complete_text(self, prompt: str):
+    def complete_text(self, prompt: str, use_cache: bool = True, options: dict = None, model: str = None,
+                      stats: dict = None):
         """
         Llama a la función COMPLETE de Snowflake para generar el código SQL a partir del prompt.
 
         Parámetros:
           - prompt: la cadena que contiene el prompt completo (incluyendo contexto y solicitud).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - options: opciones de COMPLETE para esta llamada (se combinan con las del generador).
+          - model: modelo a usar en lugar del configurado.
+          - stats: diccionario opcional (ver CortexClient.complete).
 
         Retorna:
           - El código SQL generado por el modelo.
         """
-        prompt = self.format_prompt(prompt)
-        query = (
-            f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{self.model}', '{prompt}') AS response"
-        )
+        return self.cortex.complete(model or self.model, prompt, options=options, use_cache=use_cache, stats=stats)
+
+    def complete_many(self, prompts: list, use_cache: bool = True, model: str = None):
+        """
+        Genera las respuestas de varios prompts con una sola consulta COMPLETE sobre un conjunto de filas
+        (ver CortexClient.complete_many).
+
+        Parámetros:
+          - prompts: lista de prompts completos.
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - model: modelo a usar en lugar del configurado.
 
-        print(query)  # Para depuración
+        Retorna:
+          - Lista de respuestas en el mismo orden que prompts.
+        """
+        return self.cortex.complete_many(model or self.model, prompts, use_cache=use_cache)
 
-        # Ejecuta la consulta en Snowflake y obtiene el resultado
-        result = self.session.sql(query).collect()[0]['RESPONSE']
+    def generate_code_many(self, user_requests: list, filter_: dict, limit: int = 10, use_cache: bool = True,
+                           search_token_budget: int = None, contexts: list = None, model: str = None):
+        """
+        Genera el código SQL de varias solicitudes con una sola llamada a COMPLETE (ver complete_many).
 
-        return result
+        Parámetros:
+          - user_requests: lista de solicitudes (p.ej. el contexto del primer intento de cada paso).
+          - filter_: diccionario de filtros para la búsqueda de contexto.
+          - limit: número máximo de resultados a retornar para el contexto.
+          - use_cache: si es False se ignora el cache de respuestas de COMPLETE.
+          - search_token_budget: tokens máximos (estimados) del contexto de Cortex Search.
+          - contexts: contexto de Cortex Search ya obtenido para cada solicitud (opcional).
+          - model: modelo a usar en lugar del configurado.
+
+        Retorna:
+          - Lista con el código SQL de cada solicitud.
+        """
+        contexts = contexts or [None] * len(user_requests)
+        prompts = [
+            self.build_prompt(user_request, filter_, limit, search_token_budget, context)
+            for user_request, context in zip(user_requests, contexts)
+        ]
+        codes = self.complete_many(prompts, use_cache=use_cache, model=model)
+        return [self.strip_code_fences(code) for code in codes]
+
+    def stream_text(self, prompt: str, use_cache: bool = True, model: str = None, stats: dict = None):
+        """
+        Llama a COMPLETE en modo streaming y entrega el código por fragmentos.
+
+        Parámetros:
+          - prompt: la cadena que contiene el prompt completo (incluyendo contexto y solicitud).
+          - use_cache: si es False se ignora el cache y se llama siempre a COMPLETE.
+          - model: modelo a usar en lugar del configurado.
+          - stats: diccionario opcional (ver CortexClient.complete).
+
+        Retorna:
+          - Un generador de fragmentos de texto. Si la respuesta está en cache se entrega completa.
+        """
+        return self.cortex.stream(model or self.model, prompt, use_cache=use_cache, stats=stats)
@@ -0,0 +1,140 @@
+NORMAL, SINGLE_QUOTE, DOUBLE_QUOTE, LINE_COMMENT, BLOCK_COMMENT, DOLLAR_QUOTE = range(6)
+
+# Caracteres que pueden iniciar un token de dos caracteres ($$, --, //, /*, */, '', "", \x)
+_LOOKAHEAD = set("$-/*'\"\\")
+
+
+class SqlSplitter:
+    def __init__(self):
+        """
+        Divide código SQL en sentencias de forma incremental y en tiempo lineal.
+
+        Respeta los ';' dentro de literales ('...' con '' o \\ como escape), identificadores entre
+        comillas dobles, comentarios (--, // y /* */) y cuerpos $$ ... $$ de procedimientos. El código se
+        puede entregar por fragmentos (feed) a medida que llega del modelo.
+        """
+        self._text = ""
+        self._pos = 0
+        self._start = 0
+        self._state = NORMAL
+        self._has_code = False
+
+    def feed(self, chunk: str):
+        """
+        Agrega un fragmento de código.
+
+        Retorna:
+          - Lista con las sentencias que quedaron completas (sin el ';' final).
+        """
+        # Se descarta el texto ya procesado para que el buffer no crezca con toda la respuesta
+        self._text = self._text[self._start:] + chunk
+        self._pos -= self._start
+        self._start = 0
+        return self._scan(final=False)
+
+    def finish(self):
+        """
+        Indica que no llegará más código.
+
+        Retorna:
+          - Lista con la última sentencia si quedó pendiente (aunque no termine en ';').
+        """
+        statements = self._scan(final=True)
+        if self._has_code:
+            statement = self._text[self._start:].strip()
+            if statement:
+                statements.append(statement)
+        self._text, self._pos, self._start = "", 0, 0
+        self._state, self._has_code = NORMAL, False
+        return statements
+
+    def _scan(self, final: bool):
+        text = self._text
+        end = len(text)
+        statements = []
+        pos = self._pos
+        state = self._state
+        while pos < end:
+            char = text[pos]
+            if pos + 1 < end:
+                following = text[pos + 1]
+            elif char in _LOOKAHEAD and not final:
+                # Se espera el siguiente fragmento para decidir
+                break
+            else:
+                following = ""
+
+            if state == NORMAL:
+                if char == ";":
+                    if self._has_code:
+                        statements.append(text[self._start:pos].strip())
+                    self._start = pos + 1
+                    self._has_code = False
+                elif (char == "-" and following == "-") or (char == "/" and following == "/"):
+                    state = LINE_COMMENT
+                    pos += 1
+                elif char == "/" and following == "*":
+                    state = BLOCK_COMMENT
+                    pos += 1
+                else:
+                    if not char.isspace():
+                        self._has_code = True
+                    if char == "'":
+                        state = SINGLE_QUOTE
+                    elif char == '"':
+                        state = DOUBLE_QUOTE
+                    elif char == "$" and following == "$":
+                        state = DOLLAR_QUOTE
+                        pos += 1
+            elif state == SINGLE_QUOTE:
+                if char == "\\":
+                    pos += 1
+                elif char == "'":
+                    if following == "'":
+                        pos += 1
+                    else:
+                        state = NORMAL
+            elif state == DOUBLE_QUOTE:
+                if char == '"':
+                    if following == '"':
+                        pos += 1
+                    else:
+                        state = NORMAL
+            elif state == LINE_COMMENT:
+                if char == "\n":
+                    state = NORMAL
+            elif state == BLOCK_COMMENT:
+                if char == "*" and following == "/":
+                    state = NORMAL
+                    pos += 1
+            elif state == DOLLAR_QUOTE:
+                if char == "$" and following == "$":
+                    state = NORMAL
+                    pos += 1
+            pos += 1
+
+        self._pos = pos
+        self._state = state
+        return statements
+
+
+def split_sql(sql_code: str):
+    """
+    Divide código SQL en sentencias individuales (ver SqlSplitter).
+
+    Retorna:
+      - Lista de sentencias sin el ';' final, incluida la última aunque no termine en ';'.
+    """
+    splitter = SqlSplitter()
+    return splitter.feed(sql_code) + splitter.finish()
+
+
+def iter_statements(chunks):
+    """
+    Entrega cada sentencia en cuanto termina de llegar, a partir de un generador de fragmentos
+    (p.ej. la respuesta en streaming de COMPLETE).
+    """
+    splitter = SqlSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.finish()
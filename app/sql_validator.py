@@ -0,0 +1,99 @@
+import re
+
+try:
+    import sqlglot
+    from sqlglot.errors import ParseError, SqlglotError, TokenError
+except ImportError:  # La validación local es opcional
+    sqlglot = None
+    ParseError = SqlglotError = TokenError = Exception
+
+# Sentencias que EXPLAIN puede compilar sin ejecutarlas
+EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+
+
+class SqlValidator:
+    def __init__(self, dialect: str = "snowflake", explain: bool = False):
+        """
+        Valida sentencias SQL sin ejecutarlas, para devolver los errores al generador antes de gastar
+        una ejecución en el warehouse.
+
+        Parámetros:
+          - dialect: dialecto usado por el parser local (sqlglot).
+          - explain: si es True, las consultas y DML se compilan además en Snowflake con EXPLAIN
+            (no usa el warehouse, pero es una llamada de red).
+        """
+        self.dialect = dialect
+        self.explain = explain
+
+    def validate(self, sql_code: str, session=None, explain: bool = None):
+        """
+        Valida una sentencia.
+
+        Parámetros:
+          - sql_code: la sentencia SQL a validar.
+          - session: sesión de Snowflake usada para EXPLAIN (si está activado).
+          - explain: permite desactivar EXPLAIN para esta sentencia (por defecto según el validador).
+
+        Retorna:
+          - Una tupla (válida, mensaje de error o None).
+        """
+        statement = sql_code.strip()
+        if not statement:
+            return False, "Sentencia vacía"
+
+        # Los cuerpos $$ ... $$ (procedimientos en Python/JavaScript) no son SQL: se validan en Snowflake
+        if sqlglot is not None and "$$" not in statement:
+            error = self.parse_error(statement)
+            if error is not None:
+                return False, error
+
+        explain = self.explain if explain is None else explain
+        if explain and session is not None and EXPLAINABLE.match(statement):
+            try:
+                session.sql(f"EXPLAIN USING TEXT {statement}").collect()
+            except Exception as e:
+                return False, f"Error de compilación: {e}"
+
+        return True, None
+
+    def parse_error(self, statement: str):
+        """
+        Parsea la sentencia localmente.
+
+        sqlglot no cubre toda la sintaxis de Snowflake (políticas, tareas, tablas dinámicas, opciones
+        de DDL, etc.): solo se rechazan los errores que son fallas reales, es decir, los del tokenizador
+        (literales o comentarios sin cerrar) y los errores de parseo de consultas y DML. Los errores en
+        otras sentencias se dejan pasar y, si son reales, los reporta Snowflake al ejecutarlas.
+
+        Retorna:
+          - El mensaje de error, o None si la sentencia se acepta.
+        """
+        try:
+            sqlglot.parse_one(statement, read=self.dialect)
+        except TokenError as e:
+            return f"Error de sintaxis: {e}"
+        except ParseError as e:
+            if EXPLAINABLE.match(statement):
+                return f"Error de sintaxis: {e}"
+        except SqlglotError:
+            # Sintaxis no soportada por sqlglot
+            pass
+        return None
+
+    def validate_all(self, statements: list, session=None):
+        """
+        Valida una lista de sentencias.
+
+        Después de la primera sentencia DDL ya no se usa EXPLAIN: las siguientes pueden depender de
+        objetos que esa sentencia todavía no creó.
+
+        Retorna:
+          - Lista de tuplas (válida, mensaje de error o None), una por sentencia.
+        """
+        results = []
+        explain = self.explain
+        for sql_code in statements:
+            results.append(self.validate(sql_code, session, explain=explain))
+            if not EXPLAINABLE.match(sql_code):
+                explain = False
+        return results
@@ -0,0 +1,502 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app.context_builder import PromptContextBuilder, estimate_tokens
+from app.sql_splitter import SqlSplitter
+from app.tracing import tracer
+
+# Opciones de COMPLETE de cada candidato en modo especulativo (se repiten si se piden más)
+DEFAULT_CANDIDATE_OPTIONS = [{"temperature": 0}, {"temperature": 0.5}, {"temperature": 0.9}, {"temperature": 0.3}]
+
+# Resultado de las sentencias que no se envían porque la ejecución fue cancelada
+CANCELLED = "Ejecución cancelada."
+
+
+class StepResult:
+    def __init__(self, idx: int):
+        """
+        Resultado de generar y ejecutar el código de un paso del plan.
+
+        Parámetros:
+          - idx: número del paso dentro del plan (empezando en 1).
+        """
+        self.idx = idx
+        self.valid = False
+        self.attempts = 0
+        self.sql_codes = []
+        self.events = []
+        # True si el paso no se ejecutó porque ya estaba hecho (PlanStore)
+        self.resumed = False
+
+    @property
+    def code(self):
+        """
+        Código del último intento, unido con ';'.
+        """
+        return ';'.join(self.sql_codes)
+
+
+class StepRunner:
+    def __init__(self, code_generator, filter_: dict, limit: int = 5, max_attempts: int = 3,
+                 use_cache: bool = True, stream: bool = False, statement_timeout: float = None,
+                 token_budget: int = None, validator=None, batch_statements: bool = False,
+                 store=None, resume: bool = True, candidates: int = 1, candidate_options: list = None):
+        """
+        Ejecuta el ciclo generar/ejecutar/reintentar de un paso del plan.
+
+        Parámetros:
+          - code_generator: instancia de SnowflakeCodeGenerator usada para generar y ejecutar el código.
+          - filter_: diccionario de filtros para la búsqueda de contexto.
+          - limit: número máximo de resultados de contexto por búsqueda.
+          - max_attempts: número máximo de intentos por paso.
+          - use_cache: si es False se ignora el cache de respuestas de COMPLETE.
+          - stream: si es True y hay on_event, el código se genera en streaming y se entrega
+            a on_event como un evento 'stream' con el generador de fragmentos.
+          - statement_timeout: segundos máximos por sentencia; las que lo superan se cancelan
+            y su error se usa para el siguiente intento.
+          - token_budget: presupuesto de tokens del contexto de cada prompt (por defecto según el modelo).
+          - validator: SqlValidator opcional; si alguna sentencia no pasa la validación, el intento
+            se descarta sin ejecutar nada y los errores se envían al siguiente intento.
+          - batch_statements: si es True, las sentencias de cada intento se envían juntas en un solo
+            viaje (run_queries) en lugar de una por una; statement_timeout aplica entonces a todo el lote.
+          - store: PlanStore opcional donde se guarda el resultado de cada paso exitoso.
+          - resume: si es True (y hay store), los pasos cuyas entradas no cambiaron desde una ejecución
+            exitosa anterior no se vuelven a generar ni ejecutar.
+          - candidates: número de candidatos generados en paralelo en cada intento (ver run_candidates).
+          - candidate_options: opciones de COMPLETE de cada candidato; cada una puede incluir 'model'
+            para usar otro modelo (por defecto, distintas temperaturas).
+        """
+        self.code_generator = code_generator
+        self.filter_ = filter_
+        self.limit = limit
+        self.max_attempts = max_attempts
+        self.use_cache = use_cache
+        self.stream = stream
+        self.statement_timeout = statement_timeout
+        self.token_budget = token_budget
+        self.validator = validator
+        self.batch_statements = batch_statements
+        self.store = store
+        self.resume = resume
+        self.candidates = candidates
+        self.candidate_options = candidate_options or DEFAULT_CANDIDATE_OPTIONS
+        # Identificador de la ejecución, agregado a los registros de tracing de cada paso
+        self.run_id = None
+        # Contexto de Cortex Search obtenido por adelantado para cada paso (índice -> contexto)
+        self.search_contexts = {}
+        # Código del primer intento generado en lote para los pasos independientes (índice -> código)
+        self.pregenerated_code = {}
+        # Dependencias declaradas de cada paso (ver build_step_dependencies); definen su huella en store
+        self.dependencies = None
+        # threading.Event opcional: al activarse no se inician más intentos ni se ejecutan más sentencias
+        self.cancel_event = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def prefetch_contexts(self, steps: dict):
+        """
+        Obtiene en una sola llamada, con las búsquedas en paralelo, el contexto de Cortex Search de
+        todos los pasos antes de empezar a generar código. Así la búsqueda sale del camino crítico
+        de cada intento.
+
+        Parámetros:
+          - steps: diccionario {índice: descripción del paso}.
+        """
+        indexes = list(steps)
+        contexts = self.code_generator.cortex_search_service.generate_context_many(
+            [steps[idx] for idx in indexes], self.filter_, self.limit
+        )
+        self.search_contexts.update(zip(indexes, contexts))
+
+    def pregenerate(self, steps: dict):
+        """
+        Genera el código del primer intento de varios pasos independientes con una sola llamada a
+        COMPLETE. run usa ese código en el primer intento en lugar de llamar al modelo. Si la llamada
+        en lote falla, los pasos se generan uno por uno en run.
+
+        Parámetros:
+          - steps: diccionario {índice: descripción del paso}; deben ser pasos sin dependencias.
+        """
+        # Los pasos ya hechos no necesitan código nuevo
+        steps = {idx: step for idx, step in steps.items() if self.stored_step(idx, step, []) is None}
+        if not steps:
+            return
+        context_builder = PromptContextBuilder(self.code_generator.model, self.token_budget)
+        requests = {idx: context_builder.build(step, []) for idx, step in steps.items()}
+        # Con router, una llamada por cada modelo elegido
+        groups = {}
+        for idx, request in requests.items():
+            model = self.choose_model(self.code_generator, steps[idx], 1, request,
+                                      context_builder.search_token_budget)
+            groups.setdefault(model, []).append(idx)
+        for model, indexes in groups.items():
+            try:
+                codes = self.code_generator.generate_code_many(
+                    [requests[idx] for idx in indexes], self.filter_, limit=self.limit,
+                    use_cache=self.use_cache, search_token_budget=context_builder.search_token_budget,
+                    contexts=[self.search_contexts.get(idx) for idx in indexes], model=model
+                )
+            except Exception:
+                # Si la llamada en lote falla (un prompt inválido, límite de tamaño, 429), esos pasos
+                # generan su código en su primer intento como los demás; el error queda en el tracing
+                continue
+            self.pregenerated_code.update(zip(indexes, codes))
+
+    def run(self, idx: int, step: str, previous_steps: list, code_generator=None, on_event=None):
+        """
+        Genera y ejecuta el código de un paso, reintentando con el contexto de los errores.
+
+        No llama a Streamlit: cada evento se guarda en el resultado y, si se indica, se envía a
+        on_event para mostrarlo en vivo. Así el mismo ciclo sirve en el hilo de la app y en hilos de trabajo.
+
+        Parámetros:
+          - idx: número del paso dentro del plan.
+          - step: descripción del paso.
+          - previous_steps: lista de (índice, código) de los pasos anteriores ejecutados con éxito.
+          - code_generator: generador a usar en lugar del configurado (p.ej. con su propia sesión).
+          - on_event: función opcional on_event(idx, event) para mostrar el progreso.
+
+        Retorna:
+          - Un StepResult con el estado final y los eventos del paso.
+        """
+        code_generator = code_generator or self.code_generator
+        result = StepResult(idx)
+
+        def emit(kind, **data):
+            event = dict(kind=kind, **data)
+            result.events.append(event)
+            if on_event is not None:
+                on_event(idx, event)
+
+        with tracer.context(run_id=self.run_id, step=idx), tracer.span("step") as step_span:
+            stored = self.stored_step(idx, step, previous_steps, code_generator)
+            if stored is not None:
+                # El paso ya se ejecutó con éxito con las mismas entradas
+                result.sql_codes = stored["sql_codes"]
+                result.valid = result.resumed = True
+                emit("resumed", sql=result.code)
+                step_span.update(attempts=0, retries=0, success=True, resumed=True)
+                return result
+
+            # El constructor de contexto mantiene el prompt dentro del presupuesto de tokens
+            context_builder = PromptContextBuilder(code_generator.model, self.token_budget)
+            code_generated_in_step = ""
+            while result.attempts < self.max_attempts and not result.valid and not self.cancelled:
+                result.attempts += 1
+                emit("attempt", attempt=result.attempts)
+                with tracer.span("attempt", attempt=result.attempts) as attempt_span:
+                    # Se le pasa tanto el step, el código previo exitoso y los errores anteriores (si los hay)
+                    full_context = context_builder.build(step, previous_steps, code_generated_in_step)
+                    model = self.choose_model(code_generator, step, result.attempts, full_context,
+                                              context_builder.search_token_budget)
+                    attempt_span["model"] = model or code_generator.model
+                    executed = None
+                    invalid = None
+                    generation_ms = None
+                    # Tamaño del prompt de este intento (lo completa el generador)
+                    prompt_stats = {}
+                    start = time.perf_counter()
+                    if result.attempts == 1 and idx in self.pregenerated_code:
+                        result.sql_codes = code_generator.split_sql(self.pregenerated_code.pop(idx))
+                    elif self.candidates > 1:
+                        result.sql_codes, executed, invalid = self.run_candidates(
+                            code_generator, idx, full_context, context_builder.search_token_budget, emit, model,
+                            prompt_stats, step
+                        )
+                        emit("prompt", **prompt_stats)
+                    elif self.stream and on_event is not None:
+                        # Las sentencias se validan (y ejecutan, si no es en lote) a medida que terminan de llegar
+                        result.sql_codes, executed, invalid = self.generate_streaming(
+                            code_generator, idx, full_context, on_event, context_builder.search_token_budget, model,
+                            prompt_stats, step
+                        )
+                        emit("prompt", **prompt_stats)
+                        generation_ms = (time.perf_counter() - start) * 1000
+                    else:
+                        sql_code = code_generator.generate_code(full_context, self.filter_, limit=self.limit,
+                                                                use_cache=self.use_cache,
+                                                                search_token_budget=context_builder.search_token_budget,
+                                                                context=self.search_contexts.get(idx), model=model,
+                                                                stats=prompt_stats, search_query=step)
+                        emit("prompt", **prompt_stats)
+                        result.sql_codes = code_generator.split_sql(sql_code)
+                        generation_ms = (time.perf_counter() - start) * 1000
+                    if prompt_stats.get("cached"):
+                        # Una respuesta del cache no mide la latencia del modelo
+                        generation_ms = None
+
+                    if invalid is None:
+                        invalid = self.validate(code_generator, result.sql_codes)
+                    if invalid:
+                        # Los errores vuelven directo al generador sin ejecutar el resto del código
+                        if executed:
+                            context_builder.record_attempt(result.sql_codes[:len(executed)], executed)
+                        context_builder.record_attempt([sql for sql, _ in invalid],
+                                                       [(error, False) for _, error in invalid])
+                        error_context = "".join(f"\nError: {sql} \n -> {error} \n{'*'*30}" for sql, error in invalid)
+                        result.valid = False
+                        attempt_span.update(statements=len(result.sql_codes), success=False, validation_failed=True)
+                        code_generated_in_step = result.code
+                        self.record_model(code_generator, model, generation_ms, False)
+                        emit("validation_failed", error_context=error_context)
+                        continue
+
+                    if executed is None and self.batch_statements:
+                        executed = self.run_batch(code_generator, result.sql_codes)
+
+                    error_context = ""
+                    outputs = []
+                    result.valid = True
+                    for position, sql_code in enumerate(result.sql_codes):
+                        emit("code", sql=sql_code)
+                        if executed is not None:
+                            output, success = executed[position]
+                        else:
+                            output, success = self.run_statement(code_generator, sql_code)
+                        outputs.append((output, success))
+
+                        if success:
+                            error_context += f"\nÉxito: {sql_code} \n{'*'*30}"
+                        else:
+                            error_context += f"\nError: {sql_code} \n -> {output} \n{'*'*30}"
+                            result.valid = False
+                    context_builder.record_attempt(result.sql_codes, outputs)
+                    attempt_span.update(statements=len(result.sql_codes), success=result.valid)
+                    self.record_model(code_generator, model, generation_ms, result.valid)
+
+                    if not result.valid and not self.cancelled:
+                        code_generated_in_step = result.code
+                        emit("retry", error_context=error_context)
+
+            step_span.update(attempts=result.attempts, retries=result.attempts - 1, success=result.valid)
+            if result.valid and self.store is not None:
+                self.store.save_step(self.step_fingerprint(idx, step, previous_steps, code_generator),
+                                     result, outputs)
+
+        if not result.valid:
+            emit("cancelled" if self.cancelled else "failed", attempts=result.attempts)
+        return result
+
+    def dependency_failed(self, idx: int, failed: list, on_event=None):
+        """
+        Resultado de un paso que no se ejecuta porque fallaron pasos de los que depende.
+
+        Parámetros:
+          - idx: número del paso dentro del plan.
+          - failed: índices de las dependencias que fallaron.
+          - on_event: función opcional on_event(idx, event) para mostrar el evento.
+        """
+        result = StepResult(idx)
+        event = {"kind": "dependency_failed", "dependencies": failed}
+        result.events.append(event)
+        with tracer.context(run_id=self.run_id, step=idx), tracer.span("step") as step_span:
+            step_span.update(attempts=0, retries=0, success=False, dependency_failed=failed)
+        if on_event is not None:
+            on_event(idx, event)
+        return result
+
+    def run_candidates(self, code_generator, idx: int, full_context: str, search_token_budget: int, emit,
+                       model: str = None, stats: dict = None, step: str = None):
+        """
+        Intento especulativo: genera varios candidatos en paralelo (con distintas opciones o modelos)
+        y valida cada uno en cuanto llega. Solo se ejecuta el primero que pasa la validación: ejecutar
+        varios candidatos dejaría en el warehouse los efectos (DDL/DML) de los que fallan.
+
+        Cada candidato usa su propia copia del generador. Al elegir uno, las llamadas a COMPLETE de
+        los demás se cancelan en Snowflake y se esperan, para que ningún hilo siga usando la sesión
+        del paso después de retornar.
+
+        Retorna:
+          - Tupla (sentencias, resultados (resultado, éxito) o None, lista de (sentencia, error)) con el
+            mismo formato que generate_streaming: el candidato elegido y sus resultados (si fallan, el
+            paso se reintenta con sus errores como siempre), o el primero generado si ninguno pasó la
+            validación. Los candidatos sin 'model' usan el modelo indicado. Si se indica stats, recibe
+            el tamaño del prompt (igual para todos los candidatos).
+        """
+        specs = [self.candidate_options[i % len(self.candidate_options)] for i in range(self.candidates)]
+        generators = [code_generator.with_session(code_generator.session) for _ in specs]
+        fallback = ([], None, [("", "Ningún candidato se pudo generar.")])
+        chosen = None
+        validated = 0
+
+        def generate(position):
+            spec = specs[position]
+            options = {key: value for key, value in spec.items() if key != "model"}
+            candidate_stats = {}
+            with tracer.context(candidate=spec):
+                sql_code = generators[position].generate_code(full_context, self.filter_, limit=self.limit,
+                                                              use_cache=self.use_cache,
+                                                              search_token_budget=search_token_budget,
+                                                              context=self.search_contexts.get(idx),
+                                                              options=options, model=spec.get("model", model),
+                                                              stats=candidate_stats, search_query=step)
+            if stats is not None:
+                stats.update(candidate_stats)
+            return code_generator.split_sql(sql_code)
+
+        executor = ThreadPoolExecutor(max_workers=len(specs))
+        try:
+            futures = {executor.submit(tracer.bind(generate), position): position for position in range(len(specs))}
+            for future in as_completed(futures):
+                try:
+                    statements = future.result()
+                except Exception as e:
+                    # Un candidato que falla al generarse no detiene a los demás
+                    if not fallback[0]:
+                        fallback = ([], None, [("", f"Error al generar el candidato: {e}")])
+                    continue
+                validated += 1
+                invalid = self.validate(code_generator, statements)
+                if invalid:
+                    if not fallback[0]:
+                        fallback = (statements, None, invalid)
+                    continue
+                chosen = (futures[future], statements)
+                break
+        finally:
+            # Los candidatos que siguen generándose se cancelan y se esperan antes de seguir
+            for generator in generators:
+                generator.cancel_running_queries()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if chosen is None:
+            emit("candidates", count=len(specs), winner=None, validated=validated)
+            return fallback
+
+        position, statements = chosen
+        emit("candidates", count=len(specs), winner=position + 1, validated=validated)
+        if self.batch_statements:
+            outputs = self.run_batch(code_generator, statements)
+        else:
+            outputs = [self.run_statement(code_generator, sql_code) for sql_code in statements]
+        return statements, outputs, []
+
+    def run_statement(self, code_generator, sql_code: str):
+        """
+        Ejecuta una sentencia del paso (ver run_query); si la ejecución fue cancelada no se envía.
+        """
+        if self.cancelled:
+            return CANCELLED, False
+        return code_generator.run_query(sql_code, timeout=self.statement_timeout)
+
+    def run_batch(self, code_generator, statements: list):
+        """
+        Igual que run_statement, con todas las sentencias en un solo lote (ver run_queries).
+        """
+        if self.cancelled:
+            return [(CANCELLED, False)] * len(statements)
+        return code_generator.run_queries(statements, timeout=self.statement_timeout)
+
+    def choose_model(self, code_generator, step: str, attempt: int, full_context: str, search_token_budget: int):
+        """
+        Modelo del intento según el router del generador (None para usar su modelo configurado).
+        """
+        if code_generator.router is None:
+            return None
+        prompt_tokens = estimate_tokens(full_context) + (search_token_budget or 0)
+        return code_generator.router.choose("code", prompt_tokens, attempt, step)
+
+    def record_model(self, code_generator, model: str, latency_ms: float, success: bool):
+        if code_generator.router is not None and model is not None:
+            code_generator.router.record("code", model, latency_ms, success)
+
+    def stored_step(self, idx: int, step: str, previous_steps: list, code_generator=None):
+        """
+        Retorna el registro guardado del paso si ya se ejecutó con éxito con las mismas entradas
+        (y resume está activo), o None.
+        """
+        if self.store is None or not self.resume:
+            return None
+        return self.store.get_step(self.step_fingerprint(idx, step, previous_steps, code_generator))
+
+    def step_fingerprint(self, idx: int, step: str, previous_steps: list, code_generator=None):
+        """
+        Huella del paso en store: solo cuenta el código de sus dependencias declaradas (en orden de
+        índice), no el de todos los pasos que ya terminaron, que en paralelo varía entre ejecuciones.
+        """
+        code_generator = code_generator or self.code_generator
+        dependency_steps = sorted(previous_steps)
+        if self.dependencies is not None:
+            declared = self.dependencies.get(idx, set())
+            dependency_steps = [(dep, code) for dep, code in dependency_steps if dep in declared]
+        return self.store.step_fingerprint(code_generator.model, step, dependency_steps, self.filter_)
+
+    def validate(self, code_generator, statements: list):
+        """
+        Valida las sentencias con el validador configurado (si hay).
+
+        Retorna:
+          - Lista de (sentencia, error) de las sentencias que no pasaron la validación.
+        """
+        if self.validator is None:
+            return []
+        with tracer.span("validate", statements=len(statements)) as span:
+            validation = self.validator.validate_all(statements, code_generator.session)
+            invalid = [(sql, error) for sql, (ok, error) in zip(statements, validation) if not ok]
+            span["success"] = not invalid
+        return invalid
+
+    def generate_streaming(self, code_generator, idx: int, full_context: str, on_event,
+                           search_token_budget: int = None, model: str = None, stats: dict = None,
+                           step: str = None):
+        """
+        Genera el código en streaming: on_event recibe un evento 'stream' cuyo generador puede
+        consumir para mostrar el código a medida que llega.
+
+        Cada sentencia se valida (solo localmente: las anteriores pueden no haberse ejecutado aún)
+        y se envía a ejecutar en cuanto termina de llegar, en orden y sin esperar al resto de la
+        respuesta. Tras la primera sentencia inválida no se ejecuta nada más. Con batch_statements
+        solo se validan: el lote se ejecuta al terminar la respuesta.
+
+        Retorna:
+          - Tupla (sentencias, resultados (resultado, éxito) de las ejecutadas o None si se ejecutan
+            en lote, lista de (sentencia, error) de las inválidas).
+        """
+        statements = []
+        invalid = []
+        futures = []
+        splitter = SqlSplitter()
+        run_statement = tracer.bind(self.run_statement)
+
+        def submit(new_statements):
+            for sql_code in new_statements:
+                statements.append(sql_code)
+                if invalid:
+                    continue
+                if self.validator is not None:
+                    ok, error = self.validator.validate(sql_code, code_generator.session, explain=False)
+                    if not ok:
+                        invalid.append((sql_code, error))
+                        continue
+                if not self.batch_statements:
+                    futures.append(executor.submit(run_statement, code_generator, sql_code))
+
+        def tee():
+            line = ""
+            for chunk in code_generator.generate_code_stream(full_context, self.filter_, limit=self.limit,
+                                                             use_cache=self.use_cache,
+                                                             search_token_budget=search_token_budget,
+                                                             context=self.search_contexts.get(idx),
+                                                             model=model, stats=stats, search_query=step):
+                yield chunk
+                # Al separador solo llegan líneas completas, sin los delimitadores ```sql
+                line += chunk
+                lines = line.split("\n")
+                line = lines.pop()
+                submit(splitter.feed("".join(text_line + "\n" for text_line in lines
+                                             if not text_line.lstrip().startswith("```"))))
+            if not line.lstrip().startswith("```"):
+                submit(splitter.feed(line))
+            submit(splitter.finish())
+
+        # Un solo hilo: las sentencias se ejecutan en el orden en que llegan
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stream = tee()
+            on_event(idx, {"kind": "stream", "chunks": stream})
+            # Si on_event no consumió todo el generador, se termina de leer aquí
+            for _ in stream:
+                pass
+            outputs = [future.result() for future in futures]
+        return statements, None if self.batch_statements else outputs, invalid
@@ -0,0 +1,163 @@
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from app.tracing import tracer
+
+
+def build_step_dependencies(steps: list):
+    """
+    Construye el grafo de dependencias (DAG) entre los pasos del plan.
+
+    Un paso depende de un paso anterior si menciona en su 'context' (o en su descripción) el
+    objeto que el paso anterior crea, o si ambos modifican el mismo objeto.
+
+    Parámetros:
+      - steps: lista de pasos tal como vienen en el YAML ('steps').
+
+    Retorna:
+      - Un diccionario {índice: conjunto de índices de los que depende}, con índices empezando en 1.
+    """
+    names = {}
+    for idx, step in enumerate(steps, start=1):
+        name = str((step.get("object") or {}).get("name") or "").strip()
+        if name:
+            names[idx] = name
+
+    dependencies = {}
+    for idx, step in enumerate(steps, start=1):
+        text = f"{step.get('context') or ''}\n{step.get('long_step_description') or ''}"
+        deps = set()
+        for prev_idx, name in names.items():
+            if prev_idx >= idx:
+                break
+            # Se compara también el nombre sin calificar (ej. db.schema.tabla -> tabla)
+            candidates = {name, name.split(".")[-1]}
+            if names.get(idx, "").lower() == name.lower():
+                deps.add(prev_idx)
+                continue
+            for candidate in candidates:
+                if re.search(rf"(?<![\w$]){re.escape(candidate)}(?![\w$])", text, re.IGNORECASE):
+                    deps.add(prev_idx)
+                    break
+        dependencies[idx] = deps
+    return dependencies
+
+
+class StepScheduler:
+    def __init__(self, max_workers: int = 4, session_pool=None, batch_first_attempt: bool = True,
+                 acquire_timeout: float = 5):
+        """
+        Ejecuta los pasos del plan respetando sus dependencias, en paralelo cuando son independientes.
+
+        Parámetros:
+          - max_workers: número máximo de pasos ejecutándose a la vez.
+          - session_pool: SnowflakeSessionPool del que cada paso toma su propia sesión mientras
+            se ejecuta; si es None todos los pasos usan la sesión del generador.
+          - batch_first_attempt: si es True, el código del primer intento de todos los pasos sin
+            dependencias se genera con una sola llamada a COMPLETE antes de empezar.
+          - acquire_timeout: segundos máximos de espera por una sesión del pool cuando no hay pasos
+            corriendo; al agotarse, el paso usa la sesión del generador (la de la ejecución).
+        """
+        self.max_workers = max_workers
+        self.session_pool = session_pool
+        self.batch_first_attempt = batch_first_attempt
+        self.acquire_timeout = acquire_timeout
+
+    def run(self, steps: list, step_runner, descriptions: list, selected: set, on_step_done=None):
+        """
+        Ejecuta los pasos seleccionados en el orden que permiten sus dependencias. Los pasos que
+        dependen de un paso fallido no se ejecutan (su resultado tiene un evento 'dependency_failed').
+        Si se activa step_runner.cancel_event, los pasos que aún no empezaron no se ejecutan ni
+        aparecen en el resultado.
+
+        Parámetros:
+          - steps: lista de pasos del YAML, usada para construir el DAG.
+          - step_runner: instancia de StepRunner que ejecuta cada paso.
+          - descriptions: descripción de cada paso (misma posición que en steps).
+          - selected: índices (empezando en 1) de los pasos a ejecutar; el resto se ignora.
+          - on_step_done: función on_step_done(result) llamada en el hilo que invoca run
+            cada vez que termina un paso (p.ej. para mostrarlo en Streamlit).
+
+        Retorna:
+          - Un diccionario {índice: StepResult}.
+        """
+        dependencies = build_step_dependencies(steps)
+        # Las dependencias de pasos no seleccionados (ej. documentación) no bloquean
+        pending = {idx: dependencies[idx] & selected for idx in sorted(selected)}
+        results = {}
+
+        if self.batch_first_attempt:
+            roots = [idx for idx, deps in pending.items() if not deps]
+            if len(roots) > 1:
+                step_runner.pregenerate({idx: descriptions[idx - 1] for idx in roots})
+
+        def borrow_generator(block: bool):
+            if self.session_pool is None:
+                return step_runner.code_generator, None
+            # Solo se espera por una sesión si no hay pasos corriendo: las sesiones de los pasos
+            # en curso se devuelven en este mismo hilo, así que esperar aquí bloquearía el ciclo.
+            # La espera es acotada: si el pool está agotado (p.ej. cada ejecución en curso tiene su
+            # sesión), el paso usa la sesión de la ejecución, que no está ocupada por otro paso
+            try:
+                session = self.session_pool.acquire(timeout=self.acquire_timeout if block else 0)
+            except queue.Empty:
+                if not block:
+                    raise
+                return step_runner.code_generator, None
+            return step_runner.code_generator.with_session(session), session
+
+        def previous_steps():
+            return [(idx, results[idx].code) for idx in sorted(results) if results[idx].valid]
+
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while pending or running:
+                    if step_runner.cancelled:
+                        # Ejecución cancelada: no se inician más pasos, solo se esperan los que corren
+                        pending.clear()
+                    ready = [idx for idx, deps in pending.items() if deps <= results.keys()]
+                    for idx in ready:
+                        failed = sorted(dep for dep in pending[idx] if not results[dep].valid)
+                        if failed:
+                            # Los objetos que crean sus dependencias no existen: el paso no se ejecuta
+                            del pending[idx]
+                            results[idx] = step_runner.dependency_failed(idx, failed)
+                            if on_step_done is not None:
+                                on_step_done(results[idx])
+                            continue
+                        if len(running) >= self.max_workers:
+                            break
+                        try:
+                            generator, session = borrow_generator(block=not running)
+                        except queue.Empty:
+                            break
+                        del pending[idx]
+                        future = executor.submit(tracer.bind(step_runner.run), idx, descriptions[idx - 1],
+                                                 previous_steps(), generator)
+                        running[future] = (idx, session)
+
+                    if not running:
+                        if pending:
+                            # Ciclo inesperado en el grafo: se liberan los pasos en orden
+                            idx = min(pending)
+                            pending[idx] = set()
+                        continue
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        idx, session = running.pop(future)
+                        if session is not None:
+                            self.session_pool.release(session)
+                        results[idx] = future.result()
+                        if on_step_done is not None:
+                            on_step_done(results[idx])
+        finally:
+            # Si un paso falló con una excepción, las sesiones de los que seguían corriendo vuelven al
+            # pool solo cuando esos pasos terminan: antes, otra ejecución podría tomar una sesión en uso
+            wait(running)
+            for _, session in running.values():
+                if session is not None:
+                    self.session_pool.release(session)
+        return results
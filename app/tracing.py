@@ -0,0 +1,136 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class Tracer:
+    def __init__(self, path: str = None, max_records: int = 10000):
+        """
+        Registra la duración y los atributos de cada etapa del pipeline (búsqueda, COMPLETE,
+        ejecución de SQL, parseo del YAML, intentos) como registros JSON.
+
+        Parámetros:
+          - path: archivo JSONL donde se agrega cada registro (None para guardarlos solo en memoria).
+          - max_records: número máximo de registros conservados en memoria.
+        """
+        self.path = path
+        self.max_records = max_records
+        self.enabled = True
+        self._records = []
+        self._lock = threading.Lock()
+        # Pila de atributos de contexto; con contextvars se puede copiar a otros hilos (ver bind)
+        self._context = contextvars.ContextVar(f"tracer_context_{id(self)}", default=())
+
+    def configure(self, path: str = None, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+
+    def new_run_id(self):
+        return uuid.uuid4().hex[:12]
+
+    def _current_context(self):
+        merged = {}
+        for attrs in self._context.get():
+            merged.update(attrs)
+        return merged
+
+    @contextmanager
+    def context(self, **attrs):
+        """
+        Agrega atributos (p.ej. run_id, step) a todos los registros creados en este hilo dentro del
+        bloque (y en las funciones enviadas a otros hilos con bind).
+        """
+        token = self._context.set(self._context.get() + (attrs,))
+        try:
+            yield
+        finally:
+            self._context.reset(token)
+
+    def bind(self, fn):
+        """
+        Retorna fn envuelta para ejecutarse con el contexto actual (run_id, step, etc.), p.ej. al
+        enviarla a un ThreadPoolExecutor: los hilos del pool no heredan el contexto del que los usa.
+        """
+        context = contextvars.copy_context()
+
+        def run(*args, **kwargs):
+            # Una copia por llamada: un mismo Context no puede usarse en dos hilos a la vez
+            return context.copy().run(fn, *args, **kwargs)
+
+        return run
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """
+        Mide una etapa. El diccionario entregado por el with se puede completar con más atributos
+        (tokens, query_id, etc.) y se registra al terminar el bloque.
+
+        Parámetros:
+          - stage: nombre de la etapa (ej. 'search', 'complete', 'run_query').
+          - attrs: atributos iniciales del registro.
+        """
+        record = dict(self._current_context(), stage=stage, **attrs)
+        start = time.perf_counter()
+        record["ts"] = time.time()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)[:500]
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            if self.enabled:
+                self._write(record)
+
+    def record(self, stage: str, duration_ms: float, **attrs):
+        """
+        Registra una etapa medida por partes (p.ej. el parseo de cada fragmento de una respuesta en
+        streaming), con la suma de sus duraciones.
+        """
+        record = dict(self._current_context(), stage=stage, **attrs)
+        record["ts"] = time.time()
+        record["duration_ms"] = round(duration_ms, 2)
+        if self.enabled:
+            self._write(record)
+
+    def _write(self, record: dict):
+        with self._lock:
+            self._records.append(record)
+            if len(self._records) > self.max_records:
+                del self._records[:len(self._records) - self.max_records]
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+
+    def records(self, run_id: str = None):
+        """
+        Retorna los registros en memoria, opcionalmente solo los de una ejecución.
+        """
+        with self._lock:
+            return [r for r in self._records if run_id is None or r.get("run_id") == run_id]
+
+    def summary(self, run_id: str = None):
+        """
+        Agrupa los registros por paso y etapa: número de llamadas, tiempo total y tokens.
+
+        Retorna:
+          - Lista de diccionarios ordenada por paso y etapa.
+        """
+        groups = {}
+        for r in self.records(run_id):
+            key = (r.get("step", "-"), r["stage"])
+            group = groups.setdefault(key, {"step": key[0], "stage": key[1], "calls": 0, "total_ms": 0.0,
+                                            "prompt_tokens": 0, "response_tokens": 0, "errors": 0})
+            group["calls"] += 1
+            group["total_ms"] += r["duration_ms"]
+            group["prompt_tokens"] += r.get("prompt_tokens", 0)
+            group["response_tokens"] += r.get("response_tokens", 0)
+            group["errors"] += 1 if r.get("error") or r.get("success") is False else 0
+        return sorted(groups.values(), key=lambda g: (str(g["step"]), g["stage"]))
+
+
+# Instancia compartida por todos los servicios
+tracer = Tracer()
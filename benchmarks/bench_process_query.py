@@ -0,0 +1,147 @@
+"""
+Benchmark de process_query sin cuenta de Snowflake ni créditos.
+
+Reemplaza la sesión de Snowpark, la cadena Root(...).cortex_search_services[...] y
+snowflake.cortex.Complete por versiones simuladas (benchmarks/fake_snowflake.py) con latencia,
+tasa de fallas y tamaños configurables, y reporta por tamaño de plan: latencia total, llamadas
+por etapa, reintentos y memoria máxima.
+
+Uso:
+    python -m benchmarks.bench_process_query --sizes 1,5,10,25,50 --workers 1,4
+    python -m benchmarks.bench_process_query --complete-latency 0.05 --failure-rate 0.2 --output bench.jsonl
+    python -m benchmarks.bench_process_query --statements-per-step 20 --batch-statements
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+
+import app.cortex_client
+import app.cortex_search_service
+import snowflake_coder
+from app.cortex_search_service import CortexSearchService
+from app.session import SnowflakeSessionPool
+from app.snowflake_answer_service import SnowflakeAnswerService
+from app.snowflake_code_gen import SnowflakeCodeGenerator
+from app.tracing import tracer
+from benchmarks.fake_snowflake import (
+    FakeBackend, FakeConfig, FakeSessionFactory, make_fake_complete, make_fake_root
+)
+
+
+class SilentStreamlit:
+    """
+    Reemplazo de streamlit para el benchmark: acepta cualquier llamada sin dibujar nada.
+    """
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write_stream(self, stream):
+        return "".join(stream)
+
+
+def run_case(plan_steps: int, max_workers: int, args):
+    """
+    Ejecuta process_query una vez con un plan de plan_steps pasos.
+
+    Retorna:
+      - Diccionario con las métricas del caso.
+    """
+    config = FakeConfig(
+        plan_steps=plan_steps, plan_width=args.plan_width, complete_latency=args.complete_latency,
+        query_latency=args.query_latency, search_latency=args.search_latency,
+        failure_rate=args.failure_rate, statements_per_step=args.statements_per_step,
+        document_chars=args.document_chars, seed=args.seed
+    )
+    backend = FakeBackend(config)
+
+    # Se conectan las versiones simuladas en los módulos de la app
+    app.cortex_search_service.Root = make_fake_root(backend)
+    app.cortex_client.Complete = make_fake_complete(backend)
+    snowflake_coder.st = SilentStreamlit()
+
+    factory = FakeSessionFactory(backend)
+    session = factory.get_session()
+    session_pool = SnowflakeSessionPool(factory, size=max_workers + 1)
+    cortex_service = CortexSearchService(session, "db", "schema", "service",
+                                         col_context="agent_id", col_search="transcript_text")
+    options = {"max_tokens": args.max_tokens} if args.max_tokens else None
+    answer_service = SnowflakeAnswerService(session, cortex_service, options=options)
+    code_generator = SnowflakeCodeGenerator(session, cortex_service, options=options)
+
+    run_id = tracer.new_run_id()
+    tracemalloc.start()
+    start = time.perf_counter()
+    # Se descartan los print de depuración de la app para no medir la escritura en consola
+    with tracer.context(run_id=run_id), contextlib.redirect_stdout(io.StringIO()):
+        snowflake_coder.process_query("benchmark idea", answer_service, code_generator, True,
+                                      use_cache=False, max_workers=max_workers, session_pool=session_pool,
+                                      statement_timeout=args.statement_timeout, run_id=run_id,
+                                      batch_statements=args.batch_statements, candidates=args.candidates)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    session_pool.close()
+
+    step_records = [r for r in tracer.records(run_id) if r["stage"] == "step"]
+    return {
+        "plan_steps": plan_steps,
+        "max_workers": max_workers,
+        "elapsed_s": round(elapsed, 3),
+        "calls": dict(backend.calls),
+        "retries": sum(r.get("retries", 0) for r in step_records),
+        "failed_steps": sum(1 for r in step_records if not r.get("success")),
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de process_query")
+    parser.add_argument("--sizes", default="1,5,10,25,50", help="tamaños de plan separados por coma")
+    parser.add_argument("--workers", default="1,4", help="valores de max_workers separados por coma")
+    parser.add_argument("--plan-width", type=int, default=2)
+    parser.add_argument("--complete-latency", type=float, default=0.2)
+    parser.add_argument("--query-latency", type=float, default=0.02)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--statements-per-step", type=int, default=3)
+    parser.add_argument("--document-chars", type=int, default=500)
+    parser.add_argument("--statement-timeout", type=float, default=None)
+    parser.add_argument("--batch-statements", action="store_true",
+                        help="enviar las sentencias de cada paso en un solo lote")
+    parser.add_argument("--candidates", type=int, default=1, help="candidatos en paralelo por intento")
+    parser.add_argument("--max-tokens", type=int, default=None, help="opción max_tokens de COMPLETE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="archivo JSONL donde guardar los resultados")
+    args = parser.parse_args()
+
+    tracer.configure(path=None)
+    results = []
+    for max_workers in [int(w) for w in args.workers.split(",")]:
+        for plan_steps in [int(n) for n in args.sizes.split(",")]:
+            result = run_case(plan_steps, max_workers, args)
+            results.append(result)
+            print(f"pasos={result['plan_steps']:>3} workers={result['max_workers']:>2} "
+                  f"tiempo={result['elapsed_s']:>8.3f}s reintentos={result['retries']:>3} "
+                  f"fallidos={result['failed_steps']:>3} memoria={result['peak_memory_kb']:>9.1f}KB "
+                  f"llamadas={result['calls']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+
+class FakeConfig:
+    def __init__(self, plan_steps: int = 10, plan_width: int = 2, complete_latency: float = 0.5,
+                 complete_latency_per_1k_tokens: float = 0.05, query_latency: float = 0.05,
+                 search_latency: float = 0.1, failure_rate: float = 0.1, statements_per_step: int = 3,
+                 statement_chars: int = 200, search_results: int = 5, document_chars: int = 500,
+                 stream_chunk_chars: int = 40, seed: int = 0):
+        """
+        Configuración del Snowflake simulado usado por los benchmarks.
+
+        Parámetros:
+          - plan_steps: número de pasos del plan YAML que responde COMPLETE.
+          - plan_width: número de cadenas independientes de pasos (el paso i depende del paso i - plan_width).
+          - complete_latency: segundos fijos de cada llamada a COMPLETE.
+          - complete_latency_per_1k_tokens: segundos adicionales por cada 1000 tokens estimados del prompt.
+          - query_latency: segundos de cada sentencia SQL ejecutada.
+          - search_latency: segundos de cada búsqueda en Cortex Search.
+          - failure_rate: probabilidad de que una sentencia generada falle al ejecutarse.
+          - statements_per_step: sentencias SQL en cada respuesta de código.
+          - statement_chars: tamaño aproximado de cada sentencia generada.
+          - search_results: documentos devueltos por búsqueda.
+          - document_chars: tamaño de cada documento de contexto.
+          - stream_chunk_chars: tamaño de cada fragmento en COMPLETE con stream=True.
+          - seed: semilla para que las fallas sean reproducibles.
+        """
+        self.plan_steps = plan_steps
+        self.plan_width = plan_width
+        self.complete_latency = complete_latency
+        self.complete_latency_per_1k_tokens = complete_latency_per_1k_tokens
+        self.query_latency = query_latency
+        self.search_latency = search_latency
+        self.failure_rate = failure_rate
+        self.statements_per_step = statements_per_step
+        self.statement_chars = statement_chars
+        self.search_results = search_results
+        self.document_chars = document_chars
+        self.stream_chunk_chars = stream_chunk_chars
+        self.seed = seed
+
+
+class FakeBackend:
+    def __init__(self, config: FakeConfig):
+        """
+        Estado compartido por todas las sesiones simuladas: configuración, contadores de llamadas y
+        generador aleatorio.
+        """
+        self.config = config
+        self.calls = {}
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._query_ids = itertools.count(1)
+
+    def count(self, stage: str):
+        with self._lock:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.config.failure_rate
+
+    def next_query_id(self):
+        with self._lock:
+            return f"00000000-0000-0000-0000-{next(self._query_ids):012d}"
+
+    def complete(self, prompt: str):
+        """
+        Simula COMPLETE: responde un plan YAML o código SQL según el tipo de prompt.
+        """
+        self.count("complete")
+        config = self.config
+        time.sleep(config.complete_latency + config.complete_latency_per_1k_tokens * len(prompt) / 4000)
+        if "YAML Format to use" in prompt:
+            return self.plan_yaml()
+        return self.sql_code()
+
+    def plan_yaml(self):
+        config = self.config
+        lines = ["steps:"]
+        for i in range(1, config.plan_steps + 1):
+            parent = i - config.plan_width
+            context = f"Requires table_{parent} created in a previous step." if parent >= 1 else "No prerequisites."
+            lines += [
+                f"  - step_name: Step {i}",
+                "    step_type: sql_code",
+                f"    long_step_description: Create table_{i} with its columns and constraints.",
+                f"    objective: Store the data of entity {i}.",
+                f"    context: {context}",
+                "    object:",
+                f"      name: table_{i}",
+                "      type: table",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def sql_code(self):
+        config = self.config
+        statements = []
+        for i in range(config.statements_per_step):
+            columns = ", ".join(f"col_{c} STRING" for c in range(max(config.statement_chars // 14, 1)))
+            statements.append(f"CREATE OR REPLACE TABLE t_{i} ({columns});")
+        return "```sql\n" + "\n".join(statements) + "\n```"
+
+    def execute(self, query: str):
+        self.count("execute")
+        time.sleep(self.config.query_latency)
+        if self.should_fail():
+            raise RuntimeError("SQL compilation error: simulated failure")
+        return [{"status": "Statement executed successfully."}]
+
+
+class FakeAsyncJob:
+    def __init__(self, backend: FakeBackend, collect):
+        self.query_id = backend.next_query_id()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._cancelled = False
+
+        def run():
+            try:
+                self._result = collect()
+            except Exception as e:
+                self._error = e
+            self._done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def result(self):
+        self._done.wait()
+        if self._cancelled:
+            raise RuntimeError(f"Query {self.query_id} was cancelled")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class FakeDataFrame:
+    def __init__(self, backend: FakeBackend, query: str, params: list = None):
+        self.backend = backend
+        self.query = query
+        self.params = params or []
+
+    def collect(self):
+        if "SNOWFLAKE.CORTEX.COMPLETE" in self.query:
+            with_options = "PARSE_JSON" in self.query
+            if "FROM VALUES" in self.query:
+                # complete_many: modelo (y opciones) seguidos de pares (idx, prompt) enlazados
+                values = self.params[2 if with_options else 1:]
+                pairs = list(zip(values[::2], values[1::2]))
+                return [{"IDX": idx, "RESPONSE": self.response(self.backend.complete(prompt), with_options)}
+                        for idx, prompt in pairs]
+            if with_options:
+                prompt = json.loads(self.params[1])[0]["content"]
+            else:
+                prompt = self.params[1]
+            return [{"RESPONSE": self.response(self.backend.complete(prompt), with_options)}]
+        if "CURRENT_ROLE()" in self.query:
+            # Contexto de la sesión (SnowflakeSessionPool): no cuenta como ejecución
+            return [{"ROLE": "APP_ROLE", "WAREHOUSE": "APP_WH", "DATABASE": "FAKE_DB", "SCHEMA": "PUBLIC"}]
+        if self.query.startswith(("SHOW VARIABLES", "USE ", "UNSET ")):
+            return []
+        return self.backend.execute(self.query)
+
+    @staticmethod
+    def response(text: str, with_options: bool):
+        # Con opciones, COMPLETE retorna un JSON con 'choices' y 'usage'
+        if not with_options:
+            return text
+        return json.dumps({"choices": [{"messages": text}], "usage": {"completion_tokens": len(text) // 4}})
+
+    def collect_nowait(self):
+        return FakeAsyncJob(self.backend, self.collect)
+
+
+class FakeBatch:
+    def __init__(self, backend: FakeBackend, num_statements: int):
+        """
+        Lote multi-statement en curso: las sentencias se ejecutan en orden en un hilo y cada una
+        puede fallar, deteniendo las siguientes como en Snowflake.
+        """
+        self.query_id = backend.next_query_id()
+        self.children = []
+        self.error = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+        def run():
+            time.sleep(backend.config.query_latency)
+            for _ in range(num_statements):
+                query_id = backend.next_query_id()
+                backend.count("execute")
+                if self.cancelled:
+                    self.error = RuntimeError(f"SQL execution canceled ({query_id})")
+                elif backend.should_fail():
+                    self.error = RuntimeError("SQL compilation error: simulated failure")
+                if self.error is not None:
+                    self.children.append((query_id, "FAILED_WITH_ERROR", str(self.error)))
+                    break
+                self.children.append((query_id, "SUCCESS", None))
+            self._done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        """
+        Cursor del conector simulado: execute_async con num_statements cuesta un solo viaje; los
+        resultados de cada sentencia se recorren con get_results_from_sfqid y nextset.
+        """
+        self.connection = connection
+        self.backend = connection.backend
+        self.sfqid = None
+        self._rows = []
+        self._pending = []
+
+    def execute_async(self, query: str, num_statements: int = 1):
+        self.backend.count("execute_batch")
+        batch = FakeBatch(self.backend, num_statements)
+        self.connection.batches[batch.query_id] = batch
+        self.sfqid = batch.query_id
+        return {"queryId": batch.query_id}
+
+    def execute(self, query: str, *args, **kwargs):
+        # Solo se usan para cancelar un lote y consultar el historial de la sesión
+        query_id = re.search(r"'([\w-]+)'", query).group(1)
+        batch = self.connection.batches[query_id]
+        if "SYSTEM$CANCEL_QUERY" in query:
+            batch.cancelled = True
+            self._rows = [("Identified SQL statement is being canceled.",)]
+        else:
+            self._rows = list(batch.children)
+        return self
+
+    def get_results_from_sfqid(self, query_id: str):
+        batch = self.connection.batches[query_id]
+        batch.wait()
+        self._pending = [child_id for child_id, _, _ in batch.children]
+        self.nextset()
+
+    def fetchall(self):
+        return self._rows
+
+    def nextset(self):
+        if not self._pending:
+            return None
+        self.sfqid = self._pending.pop(0)
+        self._rows = [("Statement executed successfully.",)]
+        return self
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+        self.batches = {}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_query_status(self, query_id: str):
+        batch = self.batches[query_id]
+        if not batch.is_done():
+            return "RUNNING"
+        return "FAILED_WITH_ERROR" if batch.error is not None else "SUCCESS"
+
+    @staticmethod
+    def is_still_running(status: str):
+        return status == "RUNNING"
+
+    def get_query_status_throw_if_error(self, query_id: str):
+        status = self.get_query_status(query_id)
+        if status == "FAILED_WITH_ERROR":
+            raise self.batches[query_id].error
+        return status
+
+
+class FakeSession:
+    def __init__(self, backend: FakeBackend):
+        """
+        Sesión de Snowpark simulada: responde a session.sql(...).collect(), collect_nowait() y
+        expone session.connection para el modo multi-statement.
+        """
+        self.backend = backend
+        self.connection = FakeConnection(backend)
+        self.closed = False
+
+    def sql(self, query: str, params: list = None):
+        return FakeDataFrame(self.backend, query, params)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSearchService:
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def search(self, query, columns, filter, limit):
+        self.backend.count("search")
+        config = self.backend.config
+        time.sleep(config.search_latency)
+        n = min(limit, config.search_results)
+        # Documentos distintos según la consulta, con algunos repetidos entre consultas
+        seed = sum(map(ord, query[:50]))
+        results = [
+            {columns[0]: f"doc_{(seed + i) % 20}", columns[1]: "x" * config.document_chars}
+            for i in range(n)
+        ]
+        return SimpleNamespace(results=results)
+
+
+class _Catalog(dict):
+    def __init__(self, factory):
+        super().__init__()
+        self._factory = factory
+
+    def __missing__(self, key):
+        value = self._factory()
+        self[key] = value
+        return value
+
+
+def make_fake_root(backend: FakeBackend):
+    """
+    Retorna un reemplazo de snowflake.core.Root que soporta la cadena
+    Root(session).databases[db].schemas[schema].cortex_search_services[name].
+    """
+    service = FakeSearchService(backend)
+
+    def fake_root(session):
+        return SimpleNamespace(databases=_Catalog(
+            lambda: SimpleNamespace(schemas=_Catalog(
+                lambda: SimpleNamespace(cortex_search_services=_Catalog(lambda: service))
+            ))
+        ))
+
+    return fake_root
+
+
+def make_fake_complete(backend: FakeBackend):
+    """
+    Retorna un reemplazo de snowflake.cortex.Complete con soporte para stream=True.
+    """
+    def fake_complete(model, prompt, session=None, stream=False, options=None):
+        response = backend.complete(prompt)
+        if not stream:
+            return response
+        size = backend.config.stream_chunk_chars
+        return (response[i:i + size] for i in range(0, len(response), size))
+
+    return fake_complete
+
+
+class FakeSessionFactory:
+    def __init__(self, backend: FakeBackend):
+        """
+        Reemplazo de snowflake_session para SnowflakeSessionPool.
+        """
+        self.backend = backend
+
+    def get_session(self):
+        return FakeSession(self.backend)
+
+    def config(self):
+        return {"account": "fake", "database": "FAKE_DB"}
+
+    def new_session(self):
+        return FakeSession(self.backend)
+
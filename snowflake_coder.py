@@ -1,116 +1,379 @@
+import time
+import uuid
+from functools import partial
+
 import streamlit as st
-import yaml
 
-from app.session import snowflake_session
+from app.session import snowflake_session, SnowflakeSessionPool
+from app.cache import LRUCache, SQLiteCache, TieredCache, SnowflakeTableCache
+from app.completion_cache import CompletionCache
+from app.concurrency import limits
 from app.cortex_search_service import CortexSearchService
+from app.job_queue import JobQueue, QueueFullError, RecordingUI, replay_events
+from app.model_router import ModelRouter
+from app.plan_parser import PlanParser, parse_step_fragment
+from app.plan_store import PlanStore
 from app.snowflake_answer_service import SnowflakeAnswerService
 from app.snowflake_code_gen import SnowflakeCodeGenerator
+from app.sql_validator import SqlValidator
+from app.step_runner import StepRunner
+from app.tracing import tracer
+from app.step_scheduler import StepScheduler, build_step_dependencies
 from utils.utils import generate_step_descriptions, get_step_type
 
 
+@st.cache_resource
 def init_services():
+    # Se ejecuta una sola vez por proceso: Streamlit reutiliza los servicios en cada rerun y entre usuarios
     # Inicializa la sesión de Snowflake
     sf_session = snowflake_session("snowflake")
     session = sf_session.get_session()
 
+    # Registro de tiempos y tokens por etapa (una línea JSON por registro)
+    tracer.configure(path="traces.jsonl")
+
+    # Pool de sesiones: cada ejecución (y cada paso en paralelo) toma prestada su propia sesión
+    session_pool = SnowflakeSessionPool(sf_session, size=8, health_check_interval=300)
+
     # Configuración de los parámetros del servicio
     service_database = "snowflake_coder"
     service_schema = "app"
     service_name = "my_cortex_service"
 
+    # Cache de resultados de búsqueda: los reintentos de un paso repiten casi la misma consulta
+    search_cache_path = None  # Ej: "search_cache.sqlite" para activar el nivel en disco
+    search_cache = TieredCache(
+        memory=LRUCache(maxsize=512, ttl=3600),
+        disk=SQLiteCache(search_cache_path, ttl=86400) if search_cache_path else None
+    )
+
     cortex_service = CortexSearchService(
         session=session,
         service_database=service_database,
         service_schema=service_schema,
         service_name=service_name,
         col_context="agent_id",
-        col_search="transcript_text"
+        col_search="transcript_text",
+        cache=search_cache
     )
 
+    # Cache de respuestas de COMPLETE compartido por ambos servicios.
+    # Backend: "memory" (por proceso), "sqlite" (archivo local) o "snowflake" (tabla compartida)
+    completion_cache_backend = "memory"
+    if completion_cache_backend == "sqlite":
+        backend = SQLiteCache("completion_cache.sqlite", ttl=7 * 86400, table="completions")
+    elif completion_cache_backend == "snowflake":
+        backend = SnowflakeTableCache(session, f"{service_database}.{service_schema}.completion_cache", ttl=7 * 86400)
+    else:
+        backend = LRUCache(maxsize=256, ttl=86400)
+    completion_cache = CompletionCache(backend)
+
+    # Planes y pasos ya ejecutados, para reanudar tras un rerun o una caída (expiran a los 30 días;
+    # cada ejecución los limita a su usuario y base de datos, ver run_job).
+    # Backend: "sqlite" (archivo local) o "snowflake" (tabla compartida)
+    plan_store_backend = "sqlite"
+    if plan_store_backend == "snowflake":
+        plan_backend = SnowflakeTableCache(session, f"{service_database}.{service_schema}.plan_store", ttl=None)
+    else:
+        plan_backend = SQLiteCache("plan_store.sqlite", ttl=None, table="plan_store")
+    plan_store = PlanStore(plan_backend)
+
+    # Router de modelos compartido: modelos rápidos para los primeros intentos de pasos simples,
+    # más capaces al reintentar; aprende de la latencia y el éxito observados
+    router = ModelRouter()
+
+    # Opciones de COMPLETE: max_tokens acota el largo (y la latencia) de cada respuesta.
+    # El plan puede ser largo; el código de un paso, no.
     answer_service = SnowflakeAnswerService(
         session=session,
-        cortex_search_service=cortex_service
+        cortex_search_service=cortex_service,
+        completion_cache=completion_cache,
+        options={"max_tokens": 8192, "temperature": 0},
+        router=router
     )
 
     code_generator = SnowflakeCodeGenerator(
         session=session,
-        cortex_search_service=cortex_service
+        cortex_search_service=cortex_service,
+        completion_cache=completion_cache,
+        options={"max_tokens": 2048, "temperature": 0},
+        router=router
     )
 
-    return answer_service, code_generator
+    # Límites globales del proceso (todos los usuarios): llamadas a COMPLETE y ejecuciones de SQL
+    # en curso, según la cuota de Cortex y el tamaño del warehouse; reintentos con backoff ante 429
+    limits.configure(complete=4, execute=4)
+
+    # Cola de trabajos: las consultas corren fuera del hilo de la página y sobreviven a los reruns.
+    # Los usuarios se atienden por turnos, con un trabajo en ejecución por usuario
+    job_queue = JobQueue(workers=4, max_running_per_user=1, max_queued_per_user=3)
 
+    return answer_service, code_generator, session_pool, plan_store, job_queue
 
-def process_query(query_input, answer_service, code_generator, execute_query):
+
+def process_query(query_input, answer_service, code_generator, execute_query, use_cache=True,
+                  max_workers=1, session_pool=None, statement_timeout=None, run_id=None,
+                  validation="local", batch_statements=False, plan_store=None, resume=True, candidates=1,
+                  ui=None, cancel_event=None):
+    # ui: destino de la salida (streamlit o un RecordingUI cuando corre en la cola de trabajos)
+    # cancel_event: threading.Event opcional que detiene los pasos (p.ej. al cancelar el trabajo)
+    ui = ui or st
     filter_input = {}  # Aquí puedes agregar controles para definir filtros
-    # Generar la respuesta en YAML
-    with st.spinner("Generando respuesta..."):
-        rta = answer_service.generate_answer(query_input, filter_input, limit=5)
-    st.subheader("Respuesta")
-    # st.markdown(rta)
-
-    # Validar y parsear YAML
-    try:
-        steps = yaml.safe_load(rta)
-        st.success("El YAML es válido.")
-    except yaml.YAMLError as e:
-        st.error(f"Error al parsear el YAML: {e}")
+    plan_key = plan_store.plan_key(answer_service.model, query_input, filter_input) if plan_store else None
+    stored_plan = plan_store.get_plan(plan_key) if plan_store and resume else None
+    # Generar la respuesta en YAML en streaming, mostrando cada paso en cuanto llega completo y validado
+    ui.subheader("Respuesta")
+    steps_container = ui.container()
+    parser = PlanParser()
+    # Tiempo de parseo acumulado entre los fragmentos (sin la espera del modelo ni el dibujo)
+    parse_ms = 0.0
+
+    def plan_chunks():
+        nonlocal parse_ms
+        if stored_plan is not None:
+            # Plan de una ejecución anterior de la misma idea: no se vuelve a llamar al modelo
+            chunks = [stored_plan]
+        else:
+            chunks = answer_service.generate_answer_stream(query_input, filter_input, limit=5, use_cache=use_cache)
+        for chunk in chunks:
+            yield chunk
+            start = time.perf_counter()
+            completed = parser.feed(chunk)
+            parse_ms += (time.perf_counter() - start) * 1000
+            for step in completed:
+                render_plan_step(steps_container, step.to_dict())
+        start = time.perf_counter()
+        completed = parser.finish()
+        parse_ms += (time.perf_counter() - start) * 1000
+        for step in completed:
+            render_plan_step(steps_container, step.to_dict())
+
+    with ui.expander("Plan generado (YAML)", expanded=False):
+        ui.write_stream(plan_chunks())
+    tracer.record("parse_yaml", parse_ms, chars=len(parser.text), steps=len(parser.steps),
+                  broken=len(parser.broken))
+
+    # Los pasos que no se pudieron parsear ni reparar se piden de nuevo al modelo, solo ese fragmento
+    with tracer.span("repair_plan", broken=len(parser.broken)) as span:
+        if stored_plan is None:
+            answer_service.record_outcome(not parser.broken)
+        repaired = {}
+        for index, (_, fragment, error) in enumerate(parser.broken):
+            try:
+                step, _ = parse_step_fragment(answer_service.repair_step(query_input, fragment, error,
+                                                                         use_cache=use_cache))
+            except Exception:
+                # Si la llamada de reparación falla, el fragmento queda en broken y se muestra como omitido
+                continue
+            if step is not None:
+                step.repairs.append("fragmento regenerado")
+                repaired[index] = step
+                render_plan_step(steps_container, step.to_dict())
+        parser.replace_broken(repaired)
+        span["unrepaired"] = len(parser.broken)
+
+    for _, fragment, error in parser.broken:
+        ui.warning(f"Se omitió un paso del plan que no se pudo reparar: {error}")
+        ui.code(fragment)
+    if not parser.steps:
+        ui.error("No se pudo obtener ningún paso válido del plan.")
+        if stored_plan is not None:
+            plan_store.discard_plan(plan_key)
         return
+    repaired_steps = [step for step in parser.steps if step.repairs]
+    if repaired_steps:
+        ui.info("Se corrigieron pasos del plan: " +
+                "; ".join(f"{step.step_name} ({', '.join(step.repairs)})" for step in repaired_steps))
+    else:
+        ui.success("El YAML es válido.")
+    steps = parser.plan()
+
+    if stored_plan is None:
+        if plan_store is not None:
+            # Se guarda el plan ya validado y corregido
+            plan_store.save_plan(plan_key, query_input, parser.to_yaml())
+    else:
+        ui.info("Plan recuperado de una ejecución anterior; los pasos ya ejecutados no se repiten.")
 
-    code_generated_contex = 'Code previusly generated\n'
     steps_descriptions, step_types = generate_step_descriptions(steps), get_step_type(steps)
 
-    for step in steps_descriptions:
-        st.markdown(step)
+    # El código se genera en streaming solo en modo secuencial (los hilos de trabajo no pueden escribir en la página)
+    # Validación previa: "off", "local" (parser) o "explain" (parser + EXPLAIN en Snowflake)
+    validator = None if validation == "off" else SqlValidator(explain=validation == "explain")
+    runner = StepRunner(code_generator, filter_input, limit=5, max_attempts=3, use_cache=use_cache,
+                        stream=max_workers == 1, statement_timeout=statement_timeout, validator=validator,
+                        batch_statements=batch_statements, store=plan_store, resume=resume,
+                        candidates=candidates)
+    runner.run_id = run_id
+    runner.cancel_event = cancel_event
+    dependencies = build_step_dependencies(steps.get("steps", []))
+    runner.dependencies = dependencies
+    selected = {idx for idx, step_type in enumerate(step_types, start=1) if step_type == "sql_code"}
+
+    # Contexto de todos los pasos en una sola llamada, antes de empezar a generar código
+    with ui.spinner("Buscando contexto para los pasos..."):
+        runner.prefetch_contexts({idx: steps_descriptions[idx - 1] for idx in selected})
 
-    for idx, (step, step_type) in enumerate(zip(steps_descriptions, step_types), start=1):
+    if max_workers > 1:
+        # Los pasos independientes se ejecutan en paralelo; cada uno se muestra al terminar
+        scheduler = StepScheduler(max_workers=max_workers, session_pool=session_pool)
+        with ui.spinner(f"Generando y ejecutando {len(selected)} pasos (hasta {max_workers} en paralelo)..."):
+            scheduler.run(steps.get("steps", []), runner, steps_descriptions, selected,
+                          on_step_done=lambda result: render_step_result(result, steps_descriptions, step_types, ui))
+        return
 
-        if step_type != "sql_code":
+    previous_steps = []
+    failed_steps = set()
+    on_event = partial(render_step_event, ui=ui)
+    for idx in sorted(selected):
+        ui.code(f"**Paso {idx}:** {steps_descriptions[idx - 1]} - Type: {step_types[idx - 1]}")
+        failed = sorted(dependencies.get(idx, set()) & failed_steps)
+        if failed:
+            # Los objetos que crean sus dependencias no existen: el paso no se ejecuta
+            runner.dependency_failed(idx, failed, on_event=on_event)
+            failed_steps.add(idx)
             continue
+        with ui.spinner(f"Generando código para el paso {idx}..."):
+            result = runner.run(idx, steps_descriptions[idx - 1], previous_steps, on_event=on_event)
+        if result.valid:
+            previous_steps.append((idx, result.code))
+        else:
+            failed_steps.add(idx)
+
 
-        st.code(f"**Paso {idx}:** {step} - Type: {step_type}")
-        intentos = 0
-        codigo_valido = False
-        # Guardar el código generado en cada intento (para mostrarlo luego)
-        sql_codes_intento = []
-
-        # Variable para ir acumulando información de errores para pasar al generador
-        error_context = ""
-        code_generated_in_step = ""
-        while intentos < 3 and not codigo_valido:
-            intentos += 1
-            st.markdown(f"**Paso {idx}:** {intentos}")
-            with st.spinner(f"Generando código para el paso {idx} (intento {intentos})..."):
-                # Se le pasa tanto el step, el código previo exitoso y los errores anteriores (si los hay)
-                full_context = step + code_generated_contex + "\n" + code_generated_in_step + "\n" + error_context
-                sql_codes_intento = code_generator.generate_code(full_context, filter_input, limit=5)
-                sql_codes_intento = code_generator.split_sql(sql_codes_intento)
-
-            todas_ejecutadas = True
-            error_mensajes = []  # Acumulamos errores para retroalimentación
-            error_context = ""
-            codigo_valido = True
-
-            for sql_code in sql_codes_intento:
-                st.code(sql_code, language="sql")
-                result, success = code_generator.run_query(sql_code)
-
-                if success:
-                    error_context += f"\nÉxito: {sql_code} \n{'*'*30}"
-                else:
-                    error_context += f"\nError: {sql_code} \n -> {result} \n{'*'*30}"
-                    error_mensajes.append(result)
-                    codigo_valido = False
-                    todas_ejecutadas = False
-
-            if codigo_valido:
-                code_generated_contex += '\n' + ';'.join(sql_codes_intento) + '\n'
-            else:
-                code_generated_in_step = ';'.join(sql_codes_intento) + '\n'
-                st.warning("Se intentará regenerar el código para corregir los errores.")
-                st.code(error_context)
-
-        if not codigo_valido:
-            st.error(f"No se pudo ejecutar el código exitosamente para el paso {idx} después de 3 intentos.")
+def render_plan_step(container, step: dict):
+    """
+    Muestra un paso del plan (ya validado por PlanParser) recibido durante el streaming.
+    """
+    container.markdown(generate_step_descriptions({"steps": [step]})[0])
+
+
+def render_step_event(idx, event, ui=None):
+    """
+    Muestra en Streamlit (o en ui) un evento producido por StepRunner.
+    """
+    ui = ui or st
+    if event["kind"] == "stream":
+        ui.write_stream(event["chunks"])
+    elif event["kind"] == "prompt":
+        ui.caption(f"Prompt: ~{event['prompt_tokens']} tokens (contexto de búsqueda ~{event['search_tokens']})")
+    elif event["kind"] == "attempt":
+        ui.markdown(f"**Paso {idx}:** {event['attempt']}")
+    elif event["kind"] == "code":
+        ui.code(event["sql"], language="sql")
+    elif event["kind"] == "candidates":
+        if event["winner"] is None:
+            ui.caption(f"Ninguno de los {event['count']} candidatos pasó la validación ({event['validated']} validados).")
+        else:
+            ui.caption(f"Candidato {event['winner']} de {event['count']} elegido ({event['validated']} validados).")
+    elif event["kind"] == "resumed":
+        ui.info("Paso ya ejecutado con las mismas entradas; se reutiliza su resultado.")
+        ui.code(event["sql"], language="sql")
+    elif event["kind"] == "retry":
+        ui.warning("Se intentará regenerar el código para corregir los errores.")
+        ui.code(event["error_context"])
+    elif event["kind"] == "validation_failed":
+        ui.warning("El código no pasó la validación previa; se regenerará sin ejecutarlo.")
+        ui.code(event["error_context"])
+    elif event["kind"] == "dependency_failed":
+        ui.warning(f"El paso {idx} no se ejecutó porque fallaron pasos de los que depende: "
+                   f"{', '.join(map(str, event['dependencies']))}.")
+    elif event["kind"] == "cancelled":
+        ui.warning(f"El paso {idx} se detuvo porque la ejecución fue cancelada.")
+    elif event["kind"] == "failed":
+        ui.error(f"No se pudo ejecutar el código exitosamente para el paso {idx} después de {event['attempts']} intentos.")
+
+
+def render_step_result(result, steps_descriptions, step_types, ui=None):
+    """
+    Muestra un paso completo (cabecera y eventos) una vez que terminó de ejecutarse.
+    """
+    ui = ui or st
+    idx = result.idx
+    ui.code(f"**Paso {idx}:** {steps_descriptions[idx - 1]} - Type: {step_types[idx - 1]}")
+    for event in result.events:
+        render_step_event(idx, event, ui)
+
+
+def run_job(job, query_input, answer_service, code_generator, session_pool, **options):
+    """
+    Ejecuta process_query dentro de un trabajo de JobQueue. La salida se registra en el trabajo
+    (RecordingUI) y la página la reproduce en cada consulta de progreso.
+    """
+    # Cada ejecución usa una sesión prestada del pool para no serializarse con otros usuarios
+    with session_pool.session() as session, tracer.context(run_id=job.job_id):
+        request_generator = code_generator.with_session(session)
+        if options.get("plan_store") is not None:
+            # Un paso hecho por otro usuario, o en otra cuenta o base de datos, no cuenta como hecho. Se usa
+            # la configuración de la conexión: el contexto de la sesión lo puede cambiar el SQL generado
+            config = session_pool.sf_session.config()
+            scope = f"{job.user}|{config.get('account')}|{config.get('database')}"
+            options["plan_store"] = options["plan_store"].with_scope(scope)
+        request_answer_service = answer_service.with_session(session)
+        # Al cancelar el trabajo no se dejan sentencias ni llamadas a COMPLETE corriendo en el warehouse
+        job.on_cancel(request_generator.cancel_running_queries)
+        job.on_cancel(request_answer_service.cortex.cancel_running_queries)
+        try:
+            process_query(query_input, request_answer_service, request_generator,
+                          session_pool=session_pool, run_id=job.job_id, ui=RecordingUI(job),
+                          cancel_event=job.cancel_event, **options)
+        finally:
+            request_generator.cancel_running_queries()
+
+
+def current_user():
+    """
+    Retorna el identificador del usuario para la cola de trabajos: su email si la app corre con
+    autenticación, o un identificador por sesión del navegador.
+    """
+    email = getattr(getattr(st, "experimental_user", None), "email", None)
+    if email:
+        return email
+    if "user_id" not in st.session_state:
+        st.session_state["user_id"] = uuid.uuid4().hex
+    return st.session_state["user_id"]
+
+
+def render_job(job_queue, job_id, code_generator):
+    """
+    Muestra el estado y la salida de un trabajo; mientras no termina, vuelve a consultar cada segundo.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        st.warning("El trabajo ya no está disponible.")
+        st.session_state.pop("job_id", None)
+        return
+
+    status = job_queue.status(job_id)
+    if status["status"] == "queued":
+        st.info(f"En cola: posición {status['position']} (esperando {status['waited_s']} s).")
+    elif status["status"] == "running":
+        st.caption(f"En ejecución ({status['elapsed_s']} s, esperó {status['waited_s']} s en cola).")
+    if not job.done and st.button("Cancelar"):
+        job_queue.cancel(job_id)
+
+    replay_events(job.events_snapshot(), st)
+
+    if not job.done:
+        time.sleep(1)
+        st.rerun()
+
+    if job.status == "failed":
+        st.error(f"La ejecución falló: {job.error}")
+    elif job.status == "cancelled":
+        st.warning("La ejecución fue cancelada.")
+
+    with st.expander("Diagnóstico: tiempo por paso y etapa"):
+        st.dataframe(tracer.summary(job_id))
+        if code_generator.router is not None:
+            st.dataframe(code_generator.router.stats())
+
+    cache_stats = code_generator.cortex_search_service.cache_stats()
+    if cache_stats:
+        st.caption(f"Cache de búsqueda: {cache_stats['hits']} aciertos, {cache_stats['misses']} fallos")
+    if code_generator.completion_cache is not None:
+        completion_stats = code_generator.completion_cache.stats()
+        st.caption(f"Cache de COMPLETE: {completion_stats['hits']} aciertos, {completion_stats['misses']} fallos")
 
 
 def main():
@@ -118,16 +381,36 @@ def main():
     st.write("Aplicación simple para generar pasos y código SQL basado en una idea.")
 
     # Inicializa servicios
-    answer_service, code_generator = init_services()
+    answer_service, code_generator, session_pool, plan_store, job_queue = init_services()
 
     # Uso de un formulario para la entrada de la consulta
     with st.form("form_busqueda"):
         query_input = st.text_area("Ingrese su búsqueda o idea:",
                                    height=140)
         execute_query = st.checkbox("Ejecutar consultas SQL", value=True)
+        use_cache = st.checkbox("Reutilizar respuestas en cache", value=True)
+        max_workers = st.number_input("Pasos independientes en paralelo", min_value=1, max_value=8, value=4)
+        statement_timeout = st.number_input("Tiempo máximo por sentencia (segundos)", min_value=10, value=300)
+        validation = st.selectbox("Validación previa del SQL", ["local", "explain", "off"])
+        batch_statements = st.checkbox("Enviar las sentencias de cada paso en un solo lote", value=True)
+        resume = st.checkbox("Reanudar: no repetir el plan ni los pasos ya ejecutados", value=True)
+        candidates = st.number_input("Candidatos en paralelo por intento (especulativo)", min_value=1,
+                                     max_value=4, value=1)
         submit = st.form_submit_button("Buscar")
     if submit:
-        process_query(query_input, answer_service, code_generator, execute_query)
+        # La consulta se encola y corre en un hilo de la cola; la página solo consulta su progreso
+        try:
+            job = job_queue.submit(current_user(), run_job, query_input, answer_service, code_generator,
+                                   session_pool, execute_query=execute_query, use_cache=use_cache,
+                                   max_workers=int(max_workers), statement_timeout=float(statement_timeout),
+                                   validation=validation, batch_statements=batch_statements,
+                                   plan_store=plan_store, resume=resume, candidates=int(candidates))
+            st.session_state["job_id"] = job.job_id
+        except QueueFullError as e:
+            st.warning(str(e))
+
+    if "job_id" in st.session_state:
+        render_job(job_queue, st.session_state["job_id"], code_generator)
 
 
 if __name__ == "__main__":